@@ -19,6 +19,7 @@ keep_cover_jpg: Whether to keep the cover.jpg file in the album directory
 embed_album_art: Whether to embed album art or not into the file.
 save_album_json: save the album metadata as a json file
 tries: How many times to attempt to get a valid stream URL.
+download_connections: How many connections are used to download a single file (needs HTTP Range support) or video segments at once
 path: Base download directory
 convert_to_alac: Converts a .flac file to an ALAC .m4a file (requires ffmpeg)
 save_credits_txt: Saves a {track_format}.txt file with the file containing all the credits of a specific song
@@ -27,7 +28,13 @@ save_lyrics_lrc: Saves synced lyrics as .lrc using the official Tidal provider:
 embed_lyrics: Embed the unsynced lyrics inside a FLAC/MP4 file
 genre_language: Select the language of the genres from Deezer to "en-US", "de", "fr", ...
 artwork_size: Downloads (artwork_size)x(artwork_size) album covers from iTunes, set it to 0 to disable iTunes cover
+artwork_timeout: Seconds to wait for the iTunes cover before the Tidal cover is used instead
+artwork_cache_size: MB of album covers kept in ./config/artwork for later runs, the least recently used are deleted first. 0 disables it
 resolution: Which resolution you want to download the videos
+pipe_video_segments: Feed video segments straight into ffmpeg instead of writing tmp files (an interrupted video starts over, off by default)
+skip_360ra: For artists, skip Sony 360 Reality Audio albums when the same release exists in another version
+skip_duplicate_releases: For artists, only download the best version of a release with the same title and track count (audio mode > quality > explicit)
+skip_singles_when_possible: For artists, skip single tracks which are already on an album or EP (same title or ISRC)
 
 Format variables are {title}, {artist}, {album}, {tracknumber}, {discnumber}, {date}, {quality}, {explicit}.
 quality: has a whitespace in front, so it will look like this " [Dolby Atmos]", " [360]" or " [M]" according to the downloaded quality
@@ -81,6 +88,7 @@ PRESETS = {
         "embed_album_art": True,
         "save_album_json": False,
         "tries": 5,
+        "download_connections": 4,
         "path": path,
         "track_format": "{tracknumber} - {title}",
         "playlist_format": "{playlistnumber} - {title}",
@@ -95,7 +103,10 @@ PRESETS = {
         "genre_language": "en-US",
         "artwork_size": 3000,
         "uncompressed_artwork": True,
+        "artwork_timeout": 5,
+        "artwork_cache_size": 0,
         "resolution": 1080,
+        "pipe_video_segments": False,
         "MQA_FLAC_24": True,
         "FLAC_16": True,
         "AAC_320": False,
@@ -110,7 +121,9 @@ PRESETS = {
         "aggressive_remix_filtering": True,
         "skip_singles_when_possible": True,
         "skip_360ra": True,
+        "skip_duplicate_releases": False,
         "tries": 5,
+        "download_connections": 4,
         "path": path,
         "track_format": "{tracknumber} - {title}",
         "playlist_format": "{playlistnumber} - {title}",
@@ -125,7 +138,10 @@ PRESETS = {
         "genre_language": "en-US",
         "artwork_size": 3000,
         "uncompressed_artwork": True,
+        "artwork_timeout": 5,
+        "artwork_cache_size": 0,
         "resolution": 1080,
+        "pipe_video_segments": False,
         "MQA_FLAC_24": True,
         "FLAC_16": True,
         "AAC_320": True,
@@ -138,6 +154,7 @@ PRESETS = {
         "embed_album_art": True,
         "save_album_json": False,
         "tries": 5,
+        "download_connections": 4,
         "path": path,
         "track_format": "{albumartist} - {title}",
         "playlist_format": "{playlistnumber} - {title}",
@@ -152,7 +169,10 @@ PRESETS = {
         "genre_language": "en-US",
         "artwork_size": 3000,
         "uncompressed_artwork": False,
+        "artwork_timeout": 5,
+        "artwork_cache_size": 0,
         "resolution": 1080,
+        "pipe_video_segments": False,
         "MQA_FLAC_24": True,
         "FLAC_16": True,
         "AAC_320": False,
@@ -165,6 +185,7 @@ PRESETS = {
         "embed_album_art": True,
         "save_album_json": False,
         "tries": 5,
+        "download_connections": 4,
         "path": path,
         "track_format": "{tracknumber} - {title}",
         "playlist_format": "{playlistnumber} - {title}",
@@ -179,7 +200,10 @@ PRESETS = {
         "genre_language": "en-US",
         "artwork_size": 3000,
         "uncompressed_artwork": True,
+        "artwork_timeout": 5,
+        "artwork_cache_size": 0,
         "resolution": 1080,
+        "pipe_video_segments": False,
         "MQA_FLAC_24": False,
         "FLAC_16": True,
         "AAC_320": False,
@@ -10,7 +10,7 @@ USER_AGENT_HEADER = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML,
 
 
 class Deezer:
-    def __init__(self, language='en'):
+    def __init__(self, language='en', session=None):
         requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
         self.api_url = "http://www.deezer.com/ajax/gw-light.php"
         self.legacy_api_url = "https://api.deezer.com/"
@@ -18,14 +18,18 @@ class Deezer:
             "User-Agent": USER_AGENT_HEADER,
             "Accept-Language": language
         }
-        self.session = requests.Session()
+        self.session = session if session is not None else requests.Session()
         self.session.post("https://www.deezer.com/", headers=self.http_headers, verify=False)
+        self.token = None
 
     def get_token(self):
-        token_data = self.gw_api_call('deezer.getUserData')
-        return token_data["results"]["checkForm"]
+        # The checkForm token is reused until the API rejects it
+        if self.token is None:
+            token_data = self.gw_api_call('deezer.getUserData')
+            self.token = token_data["results"]["checkForm"]
+        return self.token
 
-    def gw_api_call(self, method, args=None):
+    def gw_api_call(self, method, args=None, refresh=True):
         if args is None:
             args = {}
         try:
@@ -45,10 +49,14 @@ class Deezer:
             result_json = result.json()
         except:
             time.sleep(2)
-            return self.gw_api_call(method, args)
+            return self.gw_api_call(method, args, refresh)
         if len(result_json['error']):
+            # The cached token expired, get a new one and try once more
+            if refresh and method != 'deezer.getUserData' and 'VALID_TOKEN_REQUIRED' in result_json['error']:
+                self.token = None
+                return self.gw_api_call(method, args, False)
             raise APIError(json.dumps(result_json['error']))
-        return result.json()
+        return result_json
 
     def api_call(self, method, args=None):
         if args is None:
@@ -1,14 +1,25 @@
 #!/usr/bin/env python
 
+import copy
 import traceback
 import sys
 import os
 import re
+import threading
 import urllib3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import redsea.cli as cli
-
-from redsea.mediadownloader import MediaDownloader
+import redsea.transport as transport
+
+from redsea.async_tidal_api import Prefetcher
+from redsea.artwork import DEFAULT_DIRECTORY as ARTWORK_DIRECTORY, ArtworkCache
+from redsea.dedup import TrackIndex, pick_releases
+from redsea.decryption import decrypt_file_parallel, decrypt_security_token, is_encrypted
+from redsea.mediadownloader import MediaDownloader, postprocess
+from redsea.library import LibraryIndex
+from redsea.metadata_cache import MetadataCache
+from redsea.pipeline import Pipeline, Stage
 from redsea.tagger import Tagger
 from redsea.tidal_api import TidalApi, TidalError
 from redsea.sessions import RedseaSessionFile
@@ -37,6 +48,16 @@ d888b    `Y8bod8P' `Y8bod88P" 8""888P' `Y8bod8P' `Y888""8o
 
 MEDIA_TYPES = {'t': 'track', 'p': 'playlist', 'a': 'album', 'r': 'artist', 'v': 'video'}
 
+# Albums of an artist resolved at the same time
+DISCOGRAPHY_JOBS = 8
+
+# Queue items whose info is fetched in the background ahead of the one being downloaded
+PREFETCH_AHEAD = 2
+
+# Album fields used for paths and tags, a listing entry which has all of them is used as album info
+ALBUM_FIELDS = ('id', 'title', 'type', 'artist', 'artists', 'numberOfTracks', 'numberOfVolumes', 'releaseDate',
+                'upc', 'explicit')
+
 def main():
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     os.chdir(sys.path[0])
@@ -56,6 +77,23 @@ def main():
 
     # Check for auth flag / session settings
     RSF = RedseaSessionFile('./config/sessions.pk')
+
+    # Every request goes through one pool of keep-alive connections per host, sized for the work running at once
+    connections = preset['download_connections'] if 'download_connections' in preset else 4
+    transport.configure(args.jobs * connections + args.metadata_jobs + args.stream_jobs)
+
+    def open_caches():
+        # Metadata responses and album covers are kept between runs, redsea/metadata_cache.py lists the TTLs.
+        # Only commands which download open them, so the others don't create any files
+        if args.no_cache or TidalApi.disk_cache is not None:
+            return
+        TidalApi.disk_cache = MetadataCache(refresh=args.refresh_cache)
+        # Covers are only stored on disk if the preset gives them room
+        artwork_cache_size = preset['artwork_cache_size'] if 'artwork_cache_size' in preset else 0
+        MediaDownloader.artwork = ArtworkCache(directory=ARTWORK_DIRECTORY if artwork_cache_size > 0 else None,
+                                               refresh=args.refresh_cache,
+                                               disk_max_size=artwork_cache_size * 1024 * 1024)
+
     if args.urls[0] == 'auth' and len(args.urls) == 1:
         print('\nThe "auth" command provides the following methods:')
         print('\n  list:     Lists stored sessions if any exist')
@@ -87,7 +125,46 @@ def main():
             RSF.reauth()
             exit()
 
+    elif args.urls[0] == 'decrypt':
+        if len(args.urls) not in (2, 3) or (len(args.urls) == 3 and not os.path.isfile(args.urls[1])):
+            print('Example usage: python redsea.py decrypt ./downloads')
+            print('               python redsea.py decrypt ./downloads/track.flac <security token>')
+            exit()
+
+        if os.path.isfile(args.urls[1]):
+            files = [args.urls[1]]
+        else:
+            files = [os.path.join(root, name) for root, _, names in os.walk(args.urls[1]) for name in sorted(names)
+                     if name.lower().endswith(('.flac', '.m4a'))]
+
+        # Every track has its own key, without a token it is the one recorded in the library index
+        library = LibraryIndex() if len(args.urls) == 2 else None
+        decrypted = 0
+        for file in files:
+            # Files which already have a valid header are left alone, decrypting them again would scramble them
+            if not is_encrypted(file):
+                continue
+            key_id = args.urls[2] if library is None else library.key_id(file)
+            if not key_id:
+                print('Skipping {}, no key is known for it'.format(file))
+                continue
+            print('Decrypting ' + file)
+            if decrypt_file_parallel(file, *decrypt_security_token(key_id)):
+                decrypted += 1
+            else:
+                print('\tThe key doesn\'t match {}, it was left unchanged'.format(file))
+        print('> Decrypted {0} of {1} file(s) <'.format(decrypted, len(files)))
+        exit()
+
+    elif args.urls[0] == 'reindex':
+        directories = args.urls[1:] or [preset['path']]
+        print('Reindexing ' + ', '.join(directories))
+        indexed = LibraryIndex().reindex(directories)
+        print('> Indexed {} file(s) <'.format(indexed))
+        exit()
+
     elif args.urls[0] == 'id':
+        open_caches()
         type = None
         md = MediaDownloader(TidalApi(RSF.load_session(args.account)), preset, Tagger(preset))
 
@@ -358,9 +435,137 @@ def main():
 
     print(LOGO)
 
+    open_caches()
+
+    # Downloaded tracks are found again by track id or ISRC, wherever they are stored
+    MediaDownloader.library = LibraryIndex()
+
     # Loop through media and download if possible
     cm = 0
-    for mt in media_to_download:
+    results = []
+    failed_lock = threading.Lock()
+
+    # Transcoding and tagging run in their own processes while the next tracks download
+    post_pool = ProcessPoolExecutor(max_workers=args.postprocess_jobs) if args.postprocess_jobs > 0 else None
+
+    def guarded(stage):
+        # Handles the errors of a track in any stage, a stage is retried with another session
+        # when the current one can't stream the track
+        def run(job):
+            while True:
+                try:
+                    return stage(job)
+
+                # Catch quality error
+                except ValueError as e:
+                    print("\t" + str(e))
+                    traceback.print_exc()
+                    if args.skip is True:
+                        print('Skipping track "{} - {}" due to insufficient quality'.format(
+                            job['track']['artist']['name'], job['track']['title']))
+                    else:
+                        print('Halting on track "{} - {}" due to insufficient quality'.format(
+                            job['track']['artist']['name'], job['track']['title']))
+                    job['status'] = 'failed'
+                    return False
+
+                # Catch file name errors
+                except OSError as e:
+                    print(e)
+                    print("\tFile name too long or contains apostrophes")
+                    with failed_lock:
+                        with open('failed_tracks.txt', 'a') as file:
+                            file.write(str(job['track']['url']) + "\n")
+                    job['status'] = 'failed'
+                    return False
+
+                # Catch session audio stream privilege error
+                except AssertionError as e:
+                    if 'Unable to download track' in str(e) and BRUTEFORCE:
+
+                        # Try again with a different session
+                        try:
+                            # Reset generator if this is the first attempt
+                            if job['sessions'] is None:
+                                job['sessions'] = RSF.get_session()
+                            session, name = next(job['sessions'])
+                            job['md'].api = TidalApi(session)
+                            print('Attempting audio stream with session "{}" in region {}'.format(name, session.country_code))
+                            continue
+
+                        # Ran out of sessions, skip track
+                        except StopIteration:
+                            # Let the user know we cannot download this release and skip it
+                            print('None of the available accounts were able to download track {}. Skipping..'.format(job['track']['id']))
+                            job['status'] = 'failed'
+                            return False
+
+                    elif 'Please use a mobile session' in str(e):
+                        print(e)
+                        print('Choose one of the following mobile sessions: ')
+                        RSF.list_sessions(True)
+                        job['status'] = 'failed'
+                        return False
+
+                    # Skip
+                    else:
+                        print(str(e) + '. Skipping..')
+                        job['status'] = 'failed'
+                        return False
+
+        return run
+
+    def metadata_stage(job):
+        # Videos don't have separate stages, they are downloaded as a whole in the transfer stage
+        if 'type' not in job['track']:
+            job['item'] = job['md'].prepare_track(job['track'], job['media_info'], job['track_num'])
+        return True
+
+    def stream_stage(job):
+        if 'item' in job and not job['md'].resolve_stream(job['item'], args.overwrite):
+            job['status'] = 'skipped'
+            return False
+        return True
+
+    def transfer_stage(job):
+        if 'item' not in job:
+            job['status'] = 'skipped' if job['md'].download_video(job['track'], args.overwrite) is None else 'downloaded'
+            return False
+        job['post'] = job['md'].transfer_track(job['item'], args.overwrite)
+        return True
+
+    def post_stage(job):
+        if post_pool is not None:
+            final_file = post_pool.submit(postprocess, job['post']).result()
+        else:
+            final_file = postprocess(job['post'])
+        job['md'].record(job['post'], final_file)
+        job['status'] = 'downloaded'
+        return True
+
+    # API lookups, transfers and transcoding of different tracks overlap, each stage has its own workers.
+    # Unless any concurrency is asked for, tracks are downloaded one after another so the output stays readable
+    serial = args.jobs == 1 and args.metadata_jobs == 1 and args.stream_jobs == 1 and args.postprocess_jobs == 0
+    pipeline = Pipeline([
+        Stage('metadata', guarded(metadata_stage), args.metadata_jobs),
+        Stage('stream', guarded(stream_stage), args.stream_jobs),
+        Stage('transfer', guarded(transfer_stage), args.jobs),
+        Stage('post-processing', guarded(post_stage), max(1, args.postprocess_jobs))
+    ], serial=serial)
+
+    # One TidalApi for the whole queue, MediaDownloaders get their own copy of the preset
+    api = TidalApi(RSF.load_session(args.account))
+
+    # Info of the next few queue items is fetched in the background while the current one downloads,
+    # the first item starts right away and only a bounded number of items is held in memory
+    prefetcher = Prefetcher(api.session)
+    prefetches = {}
+
+    for index, mt in enumerate(media_to_download):
+        for ahead in range(index + 1, min(index + 1 + PREFETCH_AHEAD, len(media_to_download))):
+            media = media_to_download[ahead]
+            if ahead not in prefetches and 'id' in media and media['type'] in MEDIA_TYPES:
+                prefetches[ahead] = prefetcher.submit([media])
 
         # Is it an acceptable media type? (skip if not)
         if not mt['type'] in MEDIA_TYPES:
@@ -370,130 +575,156 @@ def main():
         cm += 1
         print('<<< Getting {0} info... >>>'.format(MEDIA_TYPES[mt['type']]))
 
-        # Create a new TidalApi and pass it to a new MediaDownloader
-        md = MediaDownloader(TidalApi(RSF.load_session(args.account)), preset.copy(), Tagger(preset))
+        md = MediaDownloader(api, preset.copy(), Tagger(preset))
 
         # Create a new session generator in case we need to switch sessions
         session_gen = RSF.get_session()
 
-        # Get media info
-        def get_tracks(media):
-            media_name = None
+        # Get media info, one (tracks, album info) unit at a time
+        def list_tracks(media, known):
+            nonlocal media_name
             tracks = []
             media_info = None
-            track_info = []
 
-            while True:
-                try:
-                    if media['type'] == 'f':
-                        lines = media['content'].split('\n')
-                        for i, l in enumerate(lines):
-                            print('Getting info for track {}/{}'.format(i, len(lines)), end='\r')
-                            tracks.append(md.api.get_track(l))
-                        print()
-
-                    # Track
-                    elif media['type'] == 't':
-                        tracks.append(md.api.get_track(media['id']))
-
-                    # Playlist
-                    elif media['type'] == 'p':
-                        # Stupid mess to get the preset path rather than the modified path when > 2 playlist links added
-                        # md = MediaDownloader(TidalApi(RSF.load_session(args.account)), preset, Tagger(preset))
-
-                        # Get playlist title to create path
-                        playlist = md.api.get_playlist(media['id'])
-
-                        # Ugly way to get the playlist creator
-                        creator = None
-                        if playlist['creator']['id'] == 0:
-                            creator = 'Tidal'
-                        elif 'name' in playlist['creator']:
-                            creator = md._sanitise_name(playlist["creator"]["name"])
-
-                        if creator:
-                            md.opts['path'] = os.path.join(md.opts['path'], f'{creator} - {md._sanitise_name(playlist["title"])}')
-                        else:
-                            md.opts['path'] = os.path.join(md.opts['path'], md._sanitise_name(playlist["title"]))
+            if media['type'] == 'f':
+                lines = media['content'].split('\n')
+                for i, l in enumerate(lines):
+                    print('Getting info for track {}/{}'.format(i, len(lines)), end='\r')
+                    tracks.append(md.api.get_track(l))
+                print()
+
+            # Track
+            elif media['type'] == 't':
+                tracks.append(known['track'] if known else md.api.get_track(media['id']))
+
+            # Playlist
+            elif media['type'] == 'p':
+                # Stupid mess to get the preset path rather than the modified path when > 2 playlist links added
+                # md = MediaDownloader(TidalApi(RSF.load_session(args.account)), preset, Tagger(preset))
 
-                        # Make sure only tracks are in playlist items
-                        playlist_items = md.api.get_playlist_items(media['id'])['items']
-                        for item_ in playlist_items:
-                            tracks.append(item_['item'])
+                # Get playlist title to create path
+                playlist = known['playlist'] if known else md.api.get_playlist(media['id'])
 
-                    # Album
-                    elif media['type'] == 'a':
-                        # Get album information
-                        media_info = md.api.get_album(media['id'])
+                # Ugly way to get the playlist creator
+                creator = None
+                if playlist['creator']['id'] == 0:
+                    creator = 'Tidal'
+                elif 'name' in playlist['creator']:
+                    creator = md._sanitise_name(playlist["creator"]["name"])
+
+                if creator:
+                    md.opts['path'] = os.path.join(md.opts['path'], f'{creator} - {md._sanitise_name(playlist["title"])}')
+                else:
+                    md.opts['path'] = os.path.join(md.opts['path'], md._sanitise_name(playlist["title"]))
 
-                        # Get a list of the tracks from the album
-                        tracks = md.api.get_album_tracks(media['id'])['items']
+                # Make sure only tracks are in playlist items
+                playlist_items = (known['items'] if known else md.api.get_playlist_items(media['id']))['items']
+                for item_ in playlist_items:
+                    tracks.append(item_['item'])
 
-                    # Video
-                    elif media['type'] == 'v':
-                        # Get video information
-                        tracks.append(md.api.get_video(media['id']))
+            # Album
+            elif media['type'] == 'a':
+                # Get album information
+                media_info = known['album'] if known else md.api.get_album(media['id'])
 
-                    # Artist
+                # Get a list of the tracks from the album
+                tracks = (known['tracks'] if known else md.api.get_album_tracks(media['id']))['items']
+
+            # Video
+            elif media['type'] == 'v':
+                # Get video information
+                tracks.append(known['video'] if known else md.api.get_video(media['id']))
+
+            # Artist
+            else:
+                # Get the name of the artist for display to user
+                media_name = md.api.get_artist(media['id'])['name']
+
+                # Collect all of the tracks from all of the artist's albums, albums and EPs are handed
+                # out as soon as they are known, singles once it is clear which of them are on an EP
+                albums = md.api.get_artist_albums(media['id'])['items'] + md.api.get_artist_albums_ep_singles(media['id'])['items']
+                if 'aggressive_remix_filtering' in preset and preset['aggressive_remix_filtering']:
+                    wanted = []
+                    for album in albums:
+                        title = album['title'].lower()
+                        if 'remix' in title or 'commentary' in title or 'karaoke' in title:
+                            print('\tSkipping ' + album['title'])
+                            continue
+                        wanted.append(album)
+                    albums = wanted
+
+                # Remove duplicate variants of the same release, like sony 360 reality audio albums
+                # when there is another version which isn't 360 reality audio
+                albums, dropped = pick_releases(
+                    albums, 'skip_360ra' in preset and preset['skip_360ra'],
+                    'skip_duplicate_releases' in preset and preset['skip_duplicate_releases'])
+                for album, reason in dropped:
+                    print('\tSkipping {} - {}'.format(reason, album['title']))
+                dropped_releases = len(dropped)
+
+                def resolve(album):
+                    # Get album information, the listing usually has all of it already
+                    if all(field in album for field in ALBUM_FIELDS):
+                        media_info = album
                     else:
-                        # Get the name of the artist for display to user
-                        media_name = md.api.get_artist(media['id'])['name']
-
-                        # Collect all of the tracks from all of the artist's albums
-                        albums = md.api.get_artist_albums(media['id'])['items'] + md.api.get_artist_albums_ep_singles(media['id'])['items']
-                        eps_info = []
-                        singles_info = []
-                        for album in albums:
-                            if 'aggressive_remix_filtering' in preset and preset['aggressive_remix_filtering']:
-                                title = album['title'].lower()
-                                if 'remix' in title or 'commentary' in title or 'karaoke' in title:
-                                    print('\tSkipping ' + album['title'])
-                                    continue
-
-                            # remove sony 360 reality audio albums if there's another (duplicate) album that isn't 360 reality audio
-                            if 'skip_360ra' in preset and preset['skip_360ra']:
-                                if 'SONY_360RA' in album['audioModes']:
-                                    is_duplicate = False
-                                    for a2 in albums:
-                                        if album['title'] == a2['title'] and album['numberOfTracks'] == a2['numberOfTracks']:
-                                            is_duplicate = True
-                                            break
-                                    if is_duplicate:
-                                        print('\tSkipping duplicate Sony 360 Reality Audio album - ' + album['title'])
-                                        continue
-
-                            # Get album information
-                            media_info = md.api.get_album(album['id'])
-
-                            # Get a list of the tracks from the album
-                            tracks = md.api.get_album_tracks(album['id'])['items']
-
-                            if 'type' in media_info and str(media_info['type']).lower() == 'single':
-                                singles_info.append((tracks, media_info))
-                            else:
-                                eps_info.append((tracks, media_info))
-
-                        if 'skip_singles_when_possible' in preset and preset['skip_singles_when_possible']:
-                            # Filter singles that also appear in albums (EPs)
-                            def track_in_ep(title):
-                                for tracks, _ in eps_info:
-                                    for t in tracks:
-                                        if t['title'] == title:
-                                            return True
-                                return False
-                            for track_info in singles_info[:]:
-                                for t in track_info[0][:]:
-                                    if track_in_ep(t['title']):
-                                        print('\tSkipping ' + t['title'])
-                                        track_info[0].remove(t)
-                                        if len(track_info[0]) == 0:
-                                            singles_info.remove(track_info)
-
-                        track_info = eps_info + singles_info
-
-                    if not track_info:
-                        track_info = [(tracks, media_info)]
-                    return media_name, track_info
+                        media_info = md.api.get_album(album['id'])
+
+                    # Get a list of the tracks from the album
+                    return md.api.get_album_tracks(album['id'])['items'], media_info
+
+                # Albums are resolved concurrently but handed out in discography order
+                ep_tracks = TrackIndex()
+                singles_info = []
+                with ThreadPoolExecutor(max_workers=DISCOGRAPHY_JOBS) as executor:
+                    for tracks, media_info in executor.map(resolve, albums):
+                        if 'type' in media_info and str(media_info['type']).lower() == 'single':
+                            singles_info.append((tracks, media_info))
+                        else:
+                            ep_tracks.add(tracks)
+                            yield tracks, media_info
+
+                skipped = 0
+                for tracks, media_info in singles_info:
+                    if 'skip_singles_when_possible' in preset and preset['skip_singles_when_possible']:
+                        # Filter singles that also appear in albums (EPs), by title or ISRC
+                        tracks, dropped_tracks = ep_tracks.filter(tracks)
+                        for t in dropped_tracks:
+                            print('\tSkipping ' + t['title'])
+                        skipped += len(dropped_tracks)
+                    if tracks:
+                        yield tracks, media_info
+
+                if dropped_releases or skipped:
+                    print('\tSkipped {} duplicate release(s) and {} single track(s) already on an album'.format(
+                        dropped_releases, skipped))
+                return
+
+            yield tracks, media_info
+
+        def get_tracks(media):
+            # Taken out so a retry with another session asks the API again
+            known = {}
+            future = prefetches.pop(index, None)
+            if future is not None:
+                try:
+                    known = future.result().get((media['type'], media['id']), {})
+                except Exception:
+                    pass
+            handed_out = set()
+
+            while True:
+                try:
+                    for tracks, media_info in list_tracks(media, known):
+                        # Units handed out before a session switch are not repeated. The listing of another
+                        # region can differ in order and content, so they are told apart by id
+                        if media_info is not None and 'id' in media_info:
+                            key = media_info['id']
+                        else:
+                            key = tuple(track['id'] for track in tracks)
+                        if key not in handed_out:
+                            handed_out.add(key)
+                            yield tracks, media_info
+                    return
 
                 # Catch region error
                 except TidalError as e:
@@ -502,123 +733,101 @@ def main():
                         try:
                             session, name = next(session_gen)
                             md.api = TidalApi(session)
+                            known = {}
                             print('Checking info fetch with session "{}" in region {}'.format(name, session.country_code))
                             continue
 
                         # Ran out of sessions
-                        except StopIteration as s:
+                        except StopIteration:
                             print(e)
-                            raise s
+                            # Let the user know we cannot download this release and skip it
+                            print('None of the available accounts were able to get info for release {}. Skipping..'.format(
+                                media['id']))
+                            return
 
                     # Skip or halt
                     else:
                         raise(e)
 
-        try:
-            media_name, track_info = get_tracks(media=mt)
-        except StopIteration:
-            # Let the user know we cannot download this release and skip it
-            print('None of the available accounts were able to get info for release {}. Skipping..'.format(mt['id']))
-            continue
-
-        total = sum([len(t[0]) for t in track_info])
-
-        # Single
-        if total == 1:
-            print('<<< Downloading single track... >>>')
-
-        # Playlist or album
-        else:
-            if mt['type'] == 'p':
-                name = md.playlist_from_id(mt['id'])['title']
-            else:
-                name = track_info[0][1]['title']
-
-            print('<<< Downloading {0} "{1}": {2} track(s) in total >>>'.format(
-                MEDIA_TYPES[mt['type']] + (' ' + media_name if media_name else ''), name, total))
-
         if args.resumeon and len(media_to_download) == 1 and mt['type'] == 'p':
             print('<<< Resuming on track {} >>>'.format(args.resumeon))
             args.resumeon -= 1
         else:
             args.resumeon = 0
 
-        cur = args.resumeon
-        for tracks, media_info in track_info:
-            for track in tracks[args.resumeon:]:
-                first = True
-
-                # Actually download the track (finally)
-                while True:
-                    try:
-                        md.download_media(track, media_info, overwrite=args.overwrite,
-                                          track_num=cur+1 if mt['type'] == 'p' else None)
-                        break
-
-                    # Catch quality error
-                    except ValueError as e:
-                        print("\t" + str(e))
-                        traceback.print_exc()
-                        if args.skip is True:
-                            print('Skipping track "{} - {}" due to insufficient quality'.format(
-                                track['artist']['name'], track['title']))
-                            break
-                        else:
-                            print('Halting on track "{} - {}" due to insufficient quality'.format(
-                                track['artist']['name'], track['title']))
-                            break
-
-                    # Catch file name errors
-                    except OSError as e:
-                        print(e)
-                        print("\tFile name too long or contains apostrophes")
-                        file = open('failed_tracks.txt', 'a')
-                        file.write(str(track['url']) + "\n")
-                        file.close()
-                        break
-
-                    # Catch session audio stream privilege error
-                    except AssertionError as e:
-                        if 'Unable to download track' in str(e) and BRUTEFORCE:
-
-                            # Try again with a different session
-                            try:
-                                # Reset generator if this is the first attempt
-                                if first:
-                                    session_gen = RSF.get_session()
-                                    first = False
-                                session, name = next(session_gen)
-                                md.api = TidalApi(session)
-                                print('Attempting audio stream with session "{}" in region {}'.format(name, session.country_code))
-                                continue
-
-                            # Ran out of sessions, skip track
-                            except StopIteration:
-                                # Let the user know we cannot download this release and skip it
-                                print('None of the available accounts were able to download track {}. Skipping..'.format(track['id']))
-                                break
-
-                        elif 'Please use a mobile session' in str(e):
-                            print(e)
-                            print('Choose one of the following mobile sessions: ')
-                            RSF.list_sessions(True)
-                            break
-
-                        # Skip
+        media_name = None
+        jobs = []
+        listing = True
+
+        def list_jobs():
+            # Flatten the queue item so every track keeps its position (and playlist number), downloads
+            # start with the first unit while the next ones are still being listed
+            nonlocal listing
+            cur = args.resumeon
+            for i, (tracks, media_info) in enumerate(get_tracks(mt)):
+                if i == 0:
+                    if mt['type'] in ('t', 'v'):
+                        print('<<< Downloading single track... >>>')
+                    else:
+                        if mt['type'] == 'p':
+                            name = md.playlist_from_id(mt['id'])['title']
                         else:
-                            print(str(e) + '. Skipping..')
-
-                # Progress of current track
-                cur += 1
-                print('=== {0}/{1} complete ({2:.0f}% done) ===\n'.format(
-                    cur, total, (cur / total) * 100))
+                            name = media_info['title']
+                        print('<<< Downloading {0} "{1}" >>>'.format(
+                            MEDIA_TYPES[mt['type']] + (' ' + media_name if media_name else ''), name))
+
+                for track in tracks[args.resumeon:]:
+                    # Every track gets its own copy so a session switch only affects itself
+                    job = {'md': copy.copy(md), 'track': track, 'media_info': media_info,
+                           'track_num': cur + 1 if mt['type'] == 'p' else None, 'sessions': None,
+                           'status': 'failed'}
+                    jobs.append(job)
+                    cur += 1
+                    yield job
+
+            listing = False
+            if len(jobs) > 1:
+                print('<<< {0} track(s) in total >>>'.format(len(jobs) + args.resumeon))
+
+        done = args.resumeon
+
+        def report(job):
+            nonlocal done
+            done += 1
+            # Progress of current track, the total grows while tracks are still being listed
+            total = len(jobs) + args.resumeon
+            print('=== {0}/{1}{2} complete ({3:.0f}% done) ===\n'.format(
+                done, total, '+' if listing else '', (done / total) * 100))
+
+        pipeline.run(list_jobs(), report)
+
+        for job in jobs:
+            results.append((job['track'], job['status']))
 
         # Progress of queue
         print('> Download queue: {0}/{1} items complete ({2:.0f}% done) <\n'.
             format(cm, len(media_to_download), (cm / len(media_to_download)) * 100))
 
+    if post_pool is not None:
+        post_pool.shutdown()
+    prefetcher.close()
+
     print('> All downloads completed. <')
 
+    # Summary in queue order, independent of the order in which workers finished
+    print('> {0} downloaded, {1} skipped, {2} failed <'.format(
+        *[sum(1 for _, status in results if status == s) for s in ('downloaded', 'skipped', 'failed')]))
+    for track, status in results:
+        if status == 'failed':
+            print('\tFailed: {} - {} ({})'.format(track['artist']['name'], track['title'], track['id']))
+
+    print('> API cache: {} <'.format(TidalApi.cache.summary()))
+    print('> Artwork cache: {} <'.format(MediaDownloader.artwork.summary()))
+
+    print('> Pipeline stages <')
+    for line in pipeline.summary():
+        print('\t' + line)
+
     # since oauth sessions can change while downloads are happening if the token gets refreshed
     RSF._save()
 
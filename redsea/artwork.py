@@ -0,0 +1,123 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+from .coalesce import get_or_fetch
+
+DEFAULT_DIRECTORY = './config/artwork'
+
+# Covers kept in memory, an uncompressed 3000px cover is a few MB
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# Once the covers on disk are larger than this, the least recently used ones are deleted
+DEFAULT_DISK_MAX_SIZE = 512 * 1024 * 1024
+
+
+class ArtworkCache(object):
+    '''
+    Encoded album covers keyed by cover UUID and requested size
+
+    The most recently used covers are kept in memory up to max_size bytes. With a
+    directory, covers are also stored on disk up to disk_max_size bytes and
+    reused by later runs; with refresh set they are only written there. A cover
+    which is already being fetched is waited for instead of fetched again.
+    '''
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, directory=None, refresh=False, disk_max_size=DEFAULT_DISK_MAX_SIZE):
+        self.max_size = max_size
+        self.directory = directory
+        self.refresh = refresh
+        self.disk_max_size = disk_max_size
+        self.disk_size = 0
+        self.covers = OrderedDict()
+        self.size = 0
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        if directory:
+            self.disk_size = sum(entry.stat().st_size for entry in self._files())
+
+    @staticmethod
+    def key(cover_id, *variant):
+        return '_'.join(str(part) for part in (cover_id,) + variant)
+
+    def _file(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jpg')
+
+    def _files(self):
+        return [entry for entry in os.scandir(self.directory) if entry.name.endswith('.jpg')]
+
+    def _remember(self, key, data):
+        # Called with the lock held
+        if key in self.covers:
+            self.size -= len(self.covers.pop(key))
+        self.covers[key] = data
+        self.size += len(data)
+        while self.size > self.max_size and len(self.covers) > 1:
+            _, dropped = self.covers.popitem(last=False)
+            self.size -= len(dropped)
+
+    def _lookup(self, key):
+        # Called with the lock held
+        if key in self.covers:
+            self.covers.move_to_end(key)
+            self.hits += 1
+            return True, self.covers[key]
+        if self.directory and not self.refresh and os.path.isfile(self._file(key)):
+            with open(self._file(key), 'rb') as f:
+                data = f.read()
+            # The modification time is when the cover was last used
+            os.utime(self._file(key))
+            self._remember(key, data)
+            self.hits += 1
+            return True, data
+        return False, None
+
+    def _store(self, key, data):
+        if data is None:
+            return
+        with self.lock:
+            self.misses += 1
+            self._remember(key, data)
+        # Covers a source doesn't have are only remembered for this run
+        if self.directory and data:
+            location = self._file(key)
+            with open(location + '.part', 'wb') as f:
+                f.write(data)
+            with self.lock:
+                if os.path.isfile(location):
+                    self.disk_size -= os.path.getsize(location)
+                os.replace(location + '.part', location)
+                self.disk_size += len(data)
+                if self.disk_size > self.disk_max_size:
+                    self._evict()
+
+    def _evict(self):
+        # Called with the lock held, the least recently used covers go until it is 10% below the limit
+        target = self.disk_max_size * 0.9
+        for entry in sorted(self._files(), key=lambda entry: entry.stat().st_mtime):
+            if self.disk_size <= target:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.disk_size -= size
+
+    def get(self, key, fetch):
+        '''
+        Returns the cover stored under key, calling fetch to download it if there is none
+
+        fetch returns the encoded cover, empty bytes if there is none or None if
+        it failed, which is not cached so the cover is fetched again next time.
+        '''
+        return get_or_fetch(self.lock, self.pending, key, self._lookup, fetch, self._store)
+
+    def summary(self):
+        return '{0} hits/{1} misses, {2} cover(s) in memory'.format(self.hits, self.misses, len(self.covers))
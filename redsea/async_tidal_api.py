@@ -0,0 +1,212 @@
+import asyncio
+import threading
+
+import aiohttp
+
+from .tidal_api import TidalApi, TidalError
+
+# Same policy as the Retry of the blocking client
+RETRIES = 10
+BACKOFF_FACTOR = 0.4
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+class AsyncTidalApi(TidalApi):
+    '''
+    TidalApi whose requests run on an asyncio event loop
+
+    Every endpoint of TidalApi is available and returns a coroutine, for example
+    await api.get_album(album_id). It has to be used as an async context manager,
+    which opens and closes the underlying aiohttp session.
+    '''
+
+    def __init__(self, session, concurrency=32, page_concurrency=TidalApi.PAGE_CONCURRENCY):
+        super().__init__(session, page_concurrency)
+        self.concurrency = concurrency
+        self.client = None
+        self.refresh_lock = None
+        # Fetches in flight by cache key, so concurrent requests for the same entity share one
+        self.pending = {}
+
+    async def __aenter__(self):
+        self.client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.concurrency, ssl=False))
+        self.refresh_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.close()
+
+    async def _refresh(self, headers):
+        # Concurrent requests failing with the same token only refresh it once
+        async with self.refresh_lock:
+            if self.session.auth_headers() == headers:
+                await asyncio.get_running_loop().run_in_executor(None, self.session.refresh)
+
+    async def _get(self, url, params=None, refresh=False):
+        full_url, params = self._prepare(url, params)
+        if self.disk_cache is not None:
+            cached = self.disk_cache.get(url, params)
+            if cached is not None:
+                return cached
+
+        # aiohttp only takes strings, requests leaves out None values
+        query = {k: str(v) for k, v in params.items() if v is not None}
+        headers = self.session.auth_headers()
+
+        for i in range(RETRIES + 1):
+            try:
+                async with self.client.get(full_url, headers=headers, params=query) as resp:
+                    status = resp.status
+                    text = await resp.text()
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                # Connection errors and timeouts are retried like failed statuses
+                if i == RETRIES:
+                    raise
+            else:
+                if status not in RETRY_STATUS or i == RETRIES:
+                    break
+            await asyncio.sleep(BACKOFF_FACTOR * (2 ** i))
+
+        if self._can_refresh(status, refresh):
+            await self._refresh(headers)
+            return await self._get(url, params, True)
+
+        return self._store(url, params, status, self._parse(status, text))
+
+    async def _cached(self, kind, id_, fetch):
+        # Shares the run-scoped cache with the blocking client
+        key = self._cache_key(kind, id_)
+        found, value = self.cache.lookup(key)
+        if found:
+            return value
+
+        task = self.pending.get(key)
+        if task is not None:
+            return await task
+
+        task = self.pending[key] = asyncio.ensure_future(fetch())
+        try:
+            value = await task
+        finally:
+            del self.pending[key]
+        self.cache.store(key, value)
+        return value
+
+    async def get_credits(self, album_id):
+        return await self._cached('credits', album_id, lambda: self._get_credits(album_id))
+
+    async def get_track(self, track_id):
+        return await self._cached('track', track_id, lambda: self._get('tracks/' + str(track_id)))
+
+    async def get_album(self, album_id):
+        return await self._cached('album', album_id, lambda: self._get('albums/' + str(album_id)))
+
+    async def get_playlist_items(self, playlist_id):
+        result = await self._get_playlist_page(playlist_id, 0)
+
+        if result['totalNumberOfItems'] <= 100:
+            return result
+
+        limit = asyncio.Semaphore(self.page_concurrency)
+
+        async def page(offset):
+            async with limit:
+                return await self._get_playlist_page(playlist_id, offset)
+
+        pages = await asyncio.gather(*[page(offset) for offset in range(100, result['totalNumberOfItems'], 100)])
+        for buf in pages:
+            result['items'] += buf['items']
+
+        return result
+
+    async def get_type_from_id(self, id_):
+        if self.disk_cache is not None:
+            type_ = self.disk_cache.get_type(id_)
+            if type_ is not None:
+                return type_
+
+        # All probes start at once but are awaited in priority order, the first one that succeeds wins
+        probes = [(type_, asyncio.ensure_future(get(id_))) for type_, get in self._type_probes()]
+        try:
+            for type_, probe in probes:
+                try:
+                    await probe
+                except TidalError:
+                    continue
+                if self.disk_cache is not None:
+                    self.disk_cache.put_type(id_, type_)
+                return type_
+        finally:
+            # The others may still be retrying, the errors of those which already failed are not of interest
+            for _, probe in probes:
+                if probe.done() and not probe.cancelled():
+                    probe.exception()
+                probe.cancel()
+
+        return None
+
+
+async def _fetch_media(api, media):
+    if media['type'] == 't':
+        return {'track': await api.get_track(media['id'])}
+    elif media['type'] == 'v':
+        return {'video': await api.get_video(media['id'])}
+    elif media['type'] == 'a':
+        album, tracks = await asyncio.gather(api.get_album(media['id']), api.get_album_tracks(media['id']))
+        return {'album': album, 'tracks': tracks}
+    elif media['type'] == 'p':
+        playlist, items = await asyncio.gather(api.get_playlist(media['id']), api.get_playlist_items(media['id']))
+        return {'playlist': playlist, 'items': items}
+    return None
+
+
+async def _fetch_all(api, media_to_download):
+    results = await asyncio.gather(*[_fetch_media(api, media) for media in media_to_download], return_exceptions=True)
+    return {(media['type'], media['id']): result for media, result in zip(media_to_download, results)
+            if result is not None and not isinstance(result, BaseException)}
+
+
+def prefetch_media(session, media_to_download, concurrency=32):
+    '''
+    Fetches the info of all tracks, videos, albums and playlists of a queue concurrently
+
+    Returns a dict keyed by (type, id). Items which failed, for example because they are
+    region-locked, are left out so they can be fetched again with the blocking client.
+    '''
+
+    async def fetch_all():
+        async with AsyncTidalApi(session, concurrency) as api:
+            return await _fetch_all(api, media_to_download)
+
+    return asyncio.run(fetch_all())
+
+
+class Prefetcher(object):
+    '''
+    Runs prefetch_media for parts of a queue on one event loop and AsyncTidalApi
+
+    The loop runs on a background thread for as long as the Prefetcher is open, so
+    the aiohttp connections are reused from one submit() to the next. submit() can
+    be called from any thread and returns a concurrent.futures.Future of the dict
+    prefetch_media would return.
+    '''
+
+    def __init__(self, session, concurrency=32):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.api = AsyncTidalApi(session, concurrency)
+        # The aiohttp session has to be created on the loop it is used on
+        self._run(self.api.__aenter__()).result()
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def submit(self, media_to_download):
+        return self._run(_fetch_all(self.api, media_to_download))
+
+    def close(self):
+        self._run(self.api.__aexit__(None, None, None)).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
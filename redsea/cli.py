@@ -51,6 +51,49 @@ def get_args():
         help='If ripping a single playlist, resume on the given track number.'
     )
 
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=int,
+        default=1,
+        help='Number of tracks to download at the same time [Default=1]'
+    )
+
+    parser.add_argument(
+        '--metadata-jobs',
+        type=int,
+        default=1,
+        help='Number of tracks whose album info is looked up at the same time [Default=1]'
+    )
+
+    parser.add_argument(
+        '--stream-jobs',
+        type=int,
+        default=1,
+        help='Number of tracks whose stream URL is requested at the same time [Default=1]'
+    )
+
+    parser.add_argument(
+        '--postprocess-jobs',
+        type=int,
+        default=0,
+        help='Number of processes converting and tagging downloaded tracks, 0 does it inline [Default=0]'
+    )
+
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        default=False,
+        help='Neither read nor write the metadata and artwork cache'
+    )
+
+    parser.add_argument(
+        '--refresh-cache',
+        action='store_true',
+        default=False,
+        help='Ignore cached metadata and artwork but store the fresh responses'
+    )
+
     parser.add_argument(
         'urls',
         nargs='+',
@@ -69,6 +112,15 @@ def get_args():
     args = parser.parse_args()
     if args.resumeon and args.resumeon <= 0:
         parser.error('--resumeon must be a positive integer')
+    if args.jobs <= 0:
+        parser.error('--jobs must be a positive integer')
+    if args.metadata_jobs <= 0 or args.stream_jobs <= 0:
+        parser.error('--metadata-jobs and --stream-jobs must be positive integers')
+    if args.postprocess_jobs < 0:
+        parser.error('--postprocess-jobs must not be negative')
+
+    if args.no_cache and args.refresh_cache:
+        parser.error('--no-cache and --refresh-cache cannot be used at the same time')
 
     # Check if only URLs or a file exists
     if len(args.urls) > 1 and args.file:
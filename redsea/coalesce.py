@@ -0,0 +1,32 @@
+import threading
+
+
+def get_or_fetch(lock, pending, key, lookup, fetch, store):
+    '''
+    Returns the cached value of key, fetching it if there is none
+
+    lookup is called with lock held and returns a (found, value) tuple. pending
+    maps keys being fetched to an Event, so a caller which needs a key someone
+    else is already fetching waits for that fetch instead of starting its own.
+    store is called with the fetched value, without the lock held.
+    '''
+    while True:
+        with lock:
+            found, value = lookup(key)
+            if found:
+                return value
+            event = pending.get(key)
+            if event is None:
+                event = pending[key] = threading.Event()
+                break
+        # Someone else is fetching it, if that fails it is tried again here
+        event.wait()
+
+    try:
+        value = fetch()
+        store(key, value)
+        return value
+    finally:
+        with lock:
+            del pending[key]
+        event.set()
@@ -1,4 +1,7 @@
 import base64
+import mmap
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 from Cryptodome.Cipher import AES
 from Cryptodome.Util import Counter
@@ -35,6 +38,25 @@ def decrypt_security_token(security_token):
     return key, nonce
 
 
+def ctr_decryptor(key, nonce, offset=0):
+    '''
+    Returns an AES-CTR decryptor positioned at the given byte offset of the stream
+
+    CTR mode is seekable, so a file can be decrypted chunk by chunk or starting
+    somewhere in the middle (e.g. when a download is resumed)
+    '''
+
+    # Every 16 byte block uses the next counter value
+    counter = Counter.new(64, prefix=nonce, initial_value=offset // 16)
+    decryptor = AES.new(key, AES.MODE_CTR, counter=counter)
+
+    # Skip into the block if the offset isn't aligned
+    if offset % 16:
+        decryptor.decrypt(bytes(offset % 16))
+
+    return decryptor
+
+
 def decrypt_file(file, key, nonce):
     '''
     Decrypts an encrypted MQA file given the file, key and nonce
@@ -51,3 +73,66 @@ def decrypt_file(file, key, nonce):
         # Replace with decrypted file
         with open(file, 'wb') as dflac:
             dflac.write(flac)
+
+
+# Size of the regions decrypted by one worker and of the slices it maps at once, multiples of the AES block size
+REGION_SIZE = 16 * 1024 * 1024
+SLICE_SIZE = 1024 * 1024
+
+
+def _decrypt_region(file, key, nonce, start, end):
+    decryptor = ctr_decryptor(key, nonce, start)
+
+    with open(file, 'r+b') as f:
+        with mmap.mmap(f.fileno(), 0) as m:
+            for offset in range(start, end, SLICE_SIZE):
+                stop = min(offset + SLICE_SIZE, end)
+                m[offset:stop] = decryptor.decrypt(m[offset:stop])
+            m.flush()
+
+
+def decrypt_file_parallel(file, key, nonce, workers=None):
+    '''
+    Decrypts an encrypted MQA file in place given the file, key and nonce
+
+    The first block is decrypted on its own first, if that doesn't give a
+    .flac/.m4a header the key is wrong and the file is left alone (returns
+    False). Otherwise the file is memory mapped and split into block aligned
+    regions which are decrypted in parallel on all cores (or the given number
+    of workers), each starting from the counter value of its first block
+    '''
+
+    size = os.path.getsize(file)
+    if size == 0:
+        return False
+
+    with open(file, 'rb') as f:
+        if not _has_signature(file, ctr_decryptor(key, nonce).decrypt(f.read(16))):
+            return False
+
+    regions = [(start, min(start + REGION_SIZE, size)) for start in range(0, size, REGION_SIZE)]
+    if len(regions) == 1 or workers == 1:
+        for start, end in regions:
+            _decrypt_region(file, key, nonce, start, end)
+        return True
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_decrypt_region, file, key, nonce, start, end) for start, end in regions]
+        for future in futures:
+            future.result()
+    return True
+
+
+def _has_signature(file, header):
+    if file.lower().endswith('.flac'):
+        return header[:4] == b'fLaC'
+    return header[4:8] == b'ftyp'
+
+
+def is_encrypted(file):
+    '''
+    Checks whether a downloaded .flac/.m4a file is still encrypted by looking for its container signature
+    '''
+
+    with open(file, 'rb') as f:
+        return not _has_signature(file, f.read(8))
@@ -0,0 +1,83 @@
+# Duplicate filtering for artist discographies. Releases are grouped by title and track count
+# in one pass and tracks are looked up by title and ISRC, so it stays linear in the catalogue size.
+
+# Lower is better
+AUDIO_MODE_RANK = {'STEREO': 0, 'DOLBY_ATMOS': 1, 'SONY_360RA': 2}
+QUALITY_RANK = {'HI_RES_LOSSLESS': 0, 'HI_RES': 1, 'LOSSLESS': 2, 'HIGH': 3, 'LOW': 4}
+
+
+def _release_key(album):
+    return album['title'].strip().lower(), album['numberOfTracks']
+
+
+def _is_360ra(album):
+    return 'SONY_360RA' in (album.get('audioModes') or [])
+
+
+def _variant_rank(album):
+    audio_mode = min([AUDIO_MODE_RANK.get(mode, len(AUDIO_MODE_RANK)) for mode in album.get('audioModes') or []],
+                     default=len(AUDIO_MODE_RANK))
+    quality = QUALITY_RANK.get(album.get('audioQuality'), len(QUALITY_RANK))
+    return audio_mode, quality, 0 if album.get('explicit') else 1
+
+
+def pick_releases(albums, skip_360ra=False, best_only=False):
+    '''
+    Drops duplicate variants of the same release from a list of albums
+
+    Albums with the same title and track count are variants of one release. With
+    skip_360ra, 360 Reality Audio variants are dropped if the release has another
+    variant. With best_only, only the best variant is kept, ranked by audio mode,
+    then quality, then explicit over clean. Returns the kept albums in their
+    original order and a list of (dropped album, reason) tuples.
+    '''
+    releases = {}
+    for album in albums:
+        releases.setdefault(_release_key(album), []).append(album)
+
+    dropped = {}
+    for variants in releases.values():
+        if len(variants) < 2:
+            continue
+
+        if best_only:
+            best = min(variants, key=_variant_rank)
+            for album in variants:
+                if album is not best:
+                    dropped[id(album)] = 'worse variant of "{}" ({})'.format(best['title'], best['id'])
+        elif skip_360ra and not all(_is_360ra(album) for album in variants):
+            for album in variants:
+                if _is_360ra(album):
+                    dropped[id(album)] = 'duplicate Sony 360 Reality Audio album'
+
+    kept = [album for album in albums if id(album) not in dropped]
+    return kept, [(album, dropped[id(album)]) for album in albums if id(album) in dropped]
+
+
+class TrackIndex(object):
+    '''
+    Titles and ISRCs of tracks which are already part of a download
+    '''
+
+    def __init__(self):
+        self.titles = set()
+        self.isrcs = set()
+
+    def add(self, tracks):
+        for track in tracks:
+            self.titles.add(track['title'])
+            if track.get('isrc'):
+                self.isrcs.add(track['isrc'])
+
+    def __contains__(self, track):
+        return track['title'] in self.titles or (bool(track.get('isrc')) and track['isrc'] in self.isrcs)
+
+    def filter(self, tracks):
+        '''
+        Splits tracks into the ones not in the index and the ones which are
+        '''
+        kept = []
+        dropped = []
+        for track in tracks:
+            (dropped if track in self else kept).append(track)
+        return kept, dropped
@@ -0,0 +1,167 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mutagen.flac import FLAC
+from mutagen.mp4 import MP4
+
+from .dedup import QUALITY_RANK
+
+DEFAULT_PATH = './config/library.db'
+
+# Freeform atoms written by the tagger
+MP4_TRACK_ID = '----:com.apple.itunes:TIDAL_TRACK_ID'
+MP4_ISRC = '----:com.apple.itunes:ISRC'
+
+
+def checksum(file):
+    h = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def read_tags(file):
+    '''
+    Returns the Tidal track id, ISRC and codec of a .flac or .m4a file, ids which aren't tagged are None
+    '''
+    if file.lower().endswith('.flac'):
+        audio = FLAC(file)
+        track_id = audio.get('tidal_track_id')
+        isrc = audio.get('isrc')
+        return track_id[0] if track_id else None, isrc[0] if isrc else None, 'flac'
+
+    audio = MP4(file)
+    tags = audio.tags or {}
+    track_id = tags.get(MP4_TRACK_ID)
+    isrc = tags.get(MP4_ISRC)
+    return (bytes(track_id[0]).decode('utf-8') if track_id else None,
+            bytes(isrc[0]).decode('utf-8') if isrc else None,
+            audio.info.codec)
+
+
+def _rank(quality, codec):
+    # Files indexed without their Tidal quality are judged by the codec
+    if quality is None:
+        quality = 'LOSSLESS' if codec in ('flac', 'alac') else 'HIGH'
+    return QUALITY_RANK.get(quality, len(QUALITY_RANK))
+
+
+def _scan(file):
+    track_id, isrc, codec = read_tags(file)
+    return os.path.abspath(file), track_id, isrc, codec, os.path.getsize(file), checksum(file)
+
+
+class LibraryIndex(object):
+    '''
+    SQLite index of the downloaded tracks, keyed by file path
+
+    Tracks are looked up by Tidal track id and ISRC, so they are found again
+    after the naming formats changed or the files were moved and reindexed.
+    '''
+
+    def __init__(self, path=DEFAULT_PATH):
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tracks (path TEXT PRIMARY KEY, track_id TEXT, isrc TEXT, '
+                        'album_id TEXT, quality TEXT, codec TEXT, size INTEGER NOT NULL, checksum TEXT NOT NULL, '
+                        'added REAL NOT NULL, key_id TEXT)')
+        # Indexes created before the key id of the stream was recorded
+        if 'key_id' not in [column[1] for column in self.db.execute('PRAGMA table_info(tracks)')]:
+            self.db.execute('ALTER TABLE tracks ADD COLUMN key_id TEXT')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tracks_track_id ON tracks (track_id)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks (isrc)')
+        self.db.commit()
+
+    def add(self, file, track_id, isrc=None, album_id=None, quality=None, key_id=None):
+        '''
+        Records a finished download, its size, checksum and codec are read from the file
+
+        key_id is the security token of the stream, the key of the file if it is ever found encrypted.
+        '''
+        row = _scan(file)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                            (row[0], str(track_id), isrc, str(album_id) if album_id is not None else None, quality,
+                             row[3], row[4], row[5], time.time(), key_id))
+            self.db.commit()
+
+    def key_id(self, file):
+        '''
+        Returns the recorded security token of a file, or None
+        '''
+        with self.lock:
+            row = self.db.execute('SELECT key_id FROM tracks WHERE path = ?', (os.path.abspath(file),)).fetchone()
+        return row[0] if row else None
+
+    def find(self, track_id, isrc=None, quality=None):
+        '''
+        Returns the path of a file holding the track, or None
+
+        With quality, only files of at least that Tidal quality count. Entries
+        whose file was deleted or changed in size are dropped.
+        '''
+        with self.lock:
+            query = 'SELECT path, size, quality, codec FROM tracks WHERE {} = ?'
+            rows = self.db.execute(query.format('track_id'), (str(track_id),)).fetchall()
+            if not rows and isrc:
+                rows = self.db.execute(query.format('isrc'), (isrc,)).fetchall()
+
+            found = None
+            for path, size, stored_quality, codec in rows:
+                if not os.path.isfile(path) or os.path.getsize(path) != size:
+                    self.db.execute('DELETE FROM tracks WHERE path = ?', (path,))
+                elif quality is None or _rank(stored_quality, codec) <= QUALITY_RANK.get(quality, len(QUALITY_RANK)):
+                    found = path
+                    break
+            self.db.commit()
+        return found
+
+    def reindex(self, directories, workers=None):
+        '''
+        Rebuilds the index from the tags of all .flac/.m4a files below the given directories
+
+        Files are read in parallel. Album id, quality and key id aren't in the tags, they
+        are kept for files which were indexed before, found by path or, if they
+        were moved, by checksum. So are the ids of files tagged before they were
+        written. Returns the number of files.
+        '''
+        files = [os.path.join(root, name) for directory in directories for root, _, names in os.walk(directory)
+                 for name in sorted(names) if name.lower().endswith(('.flac', '.m4a'))]
+
+        def scan(file):
+            try:
+                return _scan(file)
+            except Exception as e:
+                print('\tSkipping {}: {}'.format(file, e))
+                return None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = [row for row in executor.map(scan, files) if row is not None]
+
+        now = time.time()
+        with self.lock:
+            known = {}
+            known_digests = {}
+            for path, digest, *info in self.db.execute(
+                    'SELECT path, checksum, track_id, isrc, album_id, quality, key_id FROM tracks').fetchall():
+                known[path] = known_digests[digest] = info
+                if not os.path.isfile(path):
+                    self.db.execute('DELETE FROM tracks WHERE path = ?', (path,))
+            for path, track_id, isrc, codec, size, digest in rows:
+                known_id, known_isrc, album_id, quality, key_id = (known.get(path) or known_digests.get(digest)
+                                                                   or [None] * 5)
+                self.db.execute('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (path, track_id or known_id, isrc or known_isrc, album_id, quality, codec, size, digest,
+                                 now, key_id))
+            self.db.commit()
+        return len(rows)
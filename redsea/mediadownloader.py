@@ -1,22 +1,25 @@
 import errno
+import functools
 import json
 import os
 import os.path as path
 import re
 import base64
 import ffmpeg
-import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 
-import requests
 from tqdm import tqdm
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 
-from .decryption import decrypt_file, decrypt_security_token
-from .tagger import FeaturingFormat
+from . import transfer, transport
+from .artwork import ArtworkCache
+from .dedup import QUALITY_RANK
+from .decryption import ctr_decryptor, decrypt_security_token
+from .tagger import FeaturingFormat, Tagger
 from .tidal_api import TidalApi, TidalRequestError, technical_names
 from deezer.deezer import Deezer, APIError
-from .videodownloader import download_stream, download_file, tags
+from .videodownloader import download_stream, tags
 
 
 def _mkdir_p(path):
@@ -30,52 +33,282 @@ def _mkdir_p(path):
             raise
 
 
+# Serialises work on shared files (album art, DRM encrypted.mp4) when tracks are downloaded concurrently
+_path_locks = {}
+_path_locks_guard = threading.Lock()
+
+
+def _path_lock(where):
+    with _path_locks_guard:
+        return _path_locks.setdefault(os.path.abspath(where), threading.Lock())
+
+
+# Seconds the preferred iTunes cover is waited for before the Tidal cover is used
+ARTWORK_TIMEOUT = 5
+
+_deezer_clients = {}
+_deezer_clients_guard = threading.Lock()
+
+# Tracks are downloaded, converted and tagged under this name and only renamed when finished,
+# so an interrupted one is never taken for a downloaded track
+UNFINISHED = '.unfinished'
+
+
+def _unfinished(track_path):
+    base, ext = path.splitext(track_path)
+    return base + UNFINISHED + ext
+
+
+def _finished(temp_file):
+    base, ext = path.splitext(temp_file)
+    return (base[:-len(UNFINISHED)] if base.endswith(UNFINISHED) else base) + ext
+
+
+def postprocess(job):
+    '''
+    Converts, tags and cleans up a downloaded track and returns the path of the final file
+
+    The track is worked on under its unfinished name and only renamed to the
+    final one when done. If anything fails the unfinished file is removed.
+
+    job only holds picklable data, so this can run in a ProcessPoolExecutor worker
+    '''
+    temp_file = job['file']
+    ftype = job['ftype']
+
+    try:
+        # Converting FLAC to ALAC
+        if job['convert_to_alac'] and ftype == 'flac':
+            print("\tConverting FLAC to ALAC...")
+            conv_file = temp_file[:-5] + ".m4a"
+            # command = 'ffmpeg -i "{0}" -vn -c:a alac "{1}"'.format(temp_file, conv_file)
+            (
+                ffmpeg
+                    .input(temp_file)
+                    .output(conv_file, acodec='alac', loglevel='warning')
+                    .overwrite_output()
+                    .run()
+            )
+
+            if path.isfile(conv_file) and not job['overwrite']:
+                print("\tConversion successful")
+                os.remove(temp_file)
+                temp_file = conv_file
+                ftype = "m4a"
+        # Converting to FLAC
+        if job['convert_to_flac'] and ftype != 'flac':
+            print(f"\tConverting {ftype} to FLAC...")
+            conv_file = re.sub(r'\.[^\.]+$', '.flac', temp_file)
+            (
+                ffmpeg
+                    .input(temp_file)
+                    .output(conv_file, acodec='flac', compression_level=8, loglevel='warning')
+                    .overwrite_output()
+                    .run()
+            )
+
+            if path.isfile(conv_file):
+                print("\tConversion successful")
+                os.remove(temp_file)
+                temp_file = conv_file
+                ftype = "flac"
+
+        # Tagging
+        print('\tTagging media file...')
+        tm = Tagger(job['format_options'])
+
+        if ftype == 'flac':
+            tm.tag_flac(temp_file, job['track_info'], job['album_info'], job['lyrics'],
+                        credits_dict=job['credits_dict'], album_art=job['album_art'])
+        elif ftype == 'm4a' or ftype == 'mp4':
+            tm.tag_m4a(temp_file, job['track_info'], job['album_info'], job['lyrics'],
+                       credits_dict=job['credits_dict'], album_art=job['album_art'])
+        else:
+            print('\tUnknown file type to tag!')
+    except BaseException:
+        if path.isfile(temp_file):
+            print('\tDeleting unfinished file ' + temp_file)
+            os.remove(temp_file)
+        raise
+
+    final_file = _finished(temp_file)
+    os.replace(temp_file, final_file)
+    return final_file
+
+
 class MediaDownloader(object):
 
+    # Album covers, shared by all instances
+    artwork = ArtworkCache()
+
+    # Optional LibraryIndex of downloaded tracks, shared by all instances
+    library = None
+
     def __init__(self, api, options, tagger=None):
         self.api = api
         self.opts = options
         self.tm = tagger
 
-        # Deezer API
-        if 'genre_language' in self.opts:
-            self.dz = Deezer(language=self.opts['genre_language'])
-        else:
-            self.dz = Deezer()
+        # Connections used per file by the segmented downloader
+        self.connections = self.opts['download_connections'] if 'download_connections' in self.opts else 4
+
+        self.session = transport.session()
+
+    @property
+    def dz(self):
+        # Deezer API, only connected on first use and shared by all downloaders with the same language
+        language = self.opts['genre_language'] if 'genre_language' in self.opts else 'en'
+        with _deezer_clients_guard:
+            if language not in _deezer_clients:
+                _deezer_clients[language] = Deezer(language=language, session=transport.new_session())
+            return _deezer_clients[language]
 
-        self.session = requests.Session()
-        retries = Retry(total=10,
-                        backoff_factor=0.4,
-                        status_forcelist=[429, 500, 502, 503, 504])
+    def _dl_url(self, url, where, decryptor=None):
+        bar = None
 
-        self.session.mount('http://', HTTPAdapter(max_retries=retries))
-        self.session.mount('https://', HTTPAdapter(max_retries=retries))
+        def progress(done, total):
+            nonlocal bar
+            if bar is None:
+                bar = tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, miniters=1, mininterval=0,
+                           bar_format='        {l_bar}{bar}{r_bar}')
+            bar.update(done - bar.n)
 
-    def _dl_url(self, url, where):
-        r = self.session.get(url, stream=True, verify=False)
         try:
-            total = int(r.headers['content-length'])
-        except KeyError:
-            return False
-        with open(where, 'wb') as f:
-            with tqdm(total=total, unit='B', unit_scale=True, unit_divisor=1024, miniters=1,
-                      bar_format='        {l_bar}{bar}{r_bar}') as bar:
-                for chunk in r.iter_content(chunk_size=1024):
-                    if chunk:  # filter out keep-alive new chunks
-                        f.write(chunk)
-                        bar.update(len(chunk))
-            print()
+            transfer.download(self.session, url, where, self.connections, progress, decryptor)
+        finally:
+            if bar is not None:
+                bar.close()
+                print()
+
         return where
 
-    def _dl_picture(self, album_id, where):
-        if album_id is not None:
-            rc = self._dl_url(TidalApi.get_album_artwork_url(album_id), where)
-            if not rc:
-                return False
-            else:
-                return rc
-        else:
-            return False
+    def _dl_picture(self, album_id):
+        if album_id is None:
+            return b''
+        r = self.session.get(TidalApi.get_album_artwork_url(album_id))
+        r.raise_for_status()
+        return r.content
+
+    def _dl_itunes_picture(self, track_info, album_info, size, compressed, max_size=None):
+        params = {
+            'country': 'US',
+            'entity': 'album',
+            'term': track_info['artist']['name'] + ' ' + track_info['album']['title']
+        }
+
+        r = self.session.get('https://itunes.apple.com/search', params=params)
+        r = r.json()
+        album_cover = None
+
+        for i in range(len(r['results'])):
+            if album_info['title'] == r['results'][i]['collectionName']:
+                # Get high resolution album cover
+                album_cover = r['results'][i]['artworkUrl100']
+                break
+
+        if album_cover is None:
+            return b''
+
+        album_cover = album_cover.replace('100x100bb.jpg', '{}x{}{}.jpg'.format(size, size, compressed))
+
+        # Check the size before downloading a cover which can't be embedded
+        if max_size is not None and compressed != 'bb':
+            cover_size = transfer.remote_size(self.session, album_cover)
+            if cover_size is not None and cover_size > max_size:
+                print('\tCover file size is too large, only {0:.2f}MB are allowed.'.format(max_size / 1024 ** 2))
+                print('\tFallback to compressed iTunes cover')
+                album_cover = album_cover.replace(compressed + '.jpg', 'bb.jpg')
+
+        r = self.session.get(album_cover)
+        r.raise_for_status()
+        return r.content
+
+    def _get_artwork(self, track_info, album_info, album_location, ftype):
+        '''
+        Returns the encoded album cover of a track, or None if there is none
+
+        iTunes and Tidal are asked at the same time. The iTunes cover is preferred
+        but only waited for until artwork_timeout seconds have passed, after that
+        the Tidal cover is used. The result is kept in the artwork cache, so this
+        happens once per album. Cover.jpg is only written if keep_cover_jpg
+        is set, an existing one is used as is.
+        '''
+        cover_location = path.join(album_location, 'Cover.jpg')
+        if self.opts['keep_cover_jpg']:
+            with _path_lock(cover_location):
+                if path.isfile(cover_location):
+                    with open(cover_location, 'rb') as f:
+                        return f.read()
+
+        cover_id = track_info['album']['cover']
+        # Albums without a cover UUID are told apart by their id
+        cover_key = cover_id or 'album-{}'.format(album_info['id'])
+
+        artwork_size = 1200
+        if 'artwork_size' in self.opts:
+            artwork_size = self.opts['artwork_size']
+
+        compressed = 'bb'
+        if 'uncompressed_artwork' in self.opts:
+            if self.opts['uncompressed_artwork']:
+                compressed = '-999'
+
+        # FLAC can't hold pictures of 16MB or more
+        max_size = 16777215 if ftype == 'flac' else None
+
+        timeout = self.opts['artwork_timeout'] if 'artwork_timeout' in self.opts else ARTWORK_TIMEOUT
+
+        # In order of preference
+        sources = []
+        if artwork_size != 0:
+            sources.append(('iTunes', lambda: self._dl_itunes_picture(track_info, album_info, artwork_size, compressed,
+                                                                      max_size)))
+        sources.append(('Tidal', lambda: self._dl_picture(cover_id)))
+
+        def race():
+            print('\tDownloading album art...')
+            executor = ThreadPoolExecutor(max_workers=len(sources))
+            try:
+                futures = [(name, executor.submit(fetch)) for name, fetch in sources]
+                failed = False
+                deadline = time.monotonic() + timeout
+                for i, (name, future) in enumerate(futures):
+                    try:
+                        # The last source is waited for as long as it takes
+                        if i + 1 < len(futures):
+                            data = future.result(max(0, deadline - time.monotonic()))
+                        else:
+                            data = future.result()
+                    except FutureTimeoutError:
+                        print('\tNo album art from {} within {}s'.format(name, timeout))
+                        failed = True
+                        continue
+                    except Exception as e:
+                        print('\tDownloading album art from {} failed: {}'.format(name, e))
+                        failed = True
+                        continue
+                    if data:
+                        print('\tUsing album art from ' + name)
+                        return data
+            finally:
+                # Slower sources are not waited for
+                executor.shutdown(wait=False)
+            # Only a cover no source has is cached as missing, after an error it is tried again
+            return None if failed else b''
+
+        # The chosen cover is cached, so all tracks of an album get the same one
+        album_art = self.artwork.get(self.artwork.key(cover_key, artwork_size, compressed, max_size), race)
+
+        if not album_art:
+            return None
+
+        if self.opts['keep_cover_jpg']:
+            with _path_lock(cover_location):
+                if not path.isfile(cover_location):
+                    with open(cover_location, 'wb') as f:
+                        f.write(album_art)
+
+        return album_art
 
     @staticmethod
     def _sanitise_name(name):
@@ -175,386 +408,415 @@ class MediaDownloader(object):
     def playlist_from_id(self, id):
         return self.api.get_playlist(id)
 
-    def download_media(self, track_info, album_info=None, overwrite=False, track_num=None):
+    def download_video(self, track_info, overwrite=False):
         track_id = track_info['id']
         assert track_info['allowStreaming'], 'Unable to download track {0}: not allowed to stream/download'.format(
             track_id)
 
         print('=== Downloading track ID {0} ==='.format(track_id))
 
-        # Check if track is video
-        if 'type' in track_info:
-            playback_info = self.api.get_video_stream_url(track_id)
-            url = playback_info['url']
-
-            # Fallback if settings doesn't exist
-            if 'resolution' not in self.opts:
-                self.opts['resolution'] = 1080
-
-            if 'video_folder_format' not in self.opts:
-                self.opts['video_folder_format'] = '{artist} - {title}{quality}'
-            if 'video_file_format' not in self.opts:
-                self.opts['video_file_format'] = '{title}'
-
-            # Make video locations
-            video_location = path.join(
-                self.opts['path'], self.opts['video_folder_format'].format(**self._normalise_video(track_info))).strip()
-            video_file = self.opts['video_file_format'].format(**self._normalise_video(track_info))
-            _mkdir_p(video_location)
-
-            file_location = os.path.join(video_location, video_file + '.mp4')
-            if path.isfile(file_location) and not overwrite:
-                print('\tFile {} already exists, skipping.'.format(file_location))
-                return None
-
-            # Get video credits
-            video_credits = self.credits_from_video(str(track_info['id']))
-            credits_dict = {}
-            if video_credits['totalNumberOfItems'] > 0:
-                for contributor in video_credits['items']:
-                    if contributor['role'] not in credits_dict:
-                        credits_dict[contributor['role']] = []
-                    credits_dict[contributor['role']].append(contributor['name'])
+        playback_info = self.api.get_video_stream_url(track_id)
+        url = playback_info['url']
+
+        # Fallback if settings doesn't exist
+        if 'resolution' not in self.opts:
+            self.opts['resolution'] = 1080
+
+        if 'video_folder_format' not in self.opts:
+            self.opts['video_folder_format'] = '{artist} - {title}{quality}'
+        if 'video_file_format' not in self.opts:
+            self.opts['video_file_format'] = '{title}'
+
+        # Make video locations
+        video_location = path.join(
+            self.opts['path'], self.opts['video_folder_format'].format(**self._normalise_video(track_info))).strip()
+        video_file = self.opts['video_file_format'].format(**self._normalise_video(track_info))
+        _mkdir_p(video_location)
+
+        file_location = os.path.join(video_location, video_file + '.mp4')
+        if path.isfile(file_location) and not overwrite:
+            print('\tFile {} already exists, skipping.'.format(file_location))
+            return None
+
+        # Get video credits
+        video_credits = self.credits_from_video(str(track_info['id']))
+        credits_dict = {}
+        if video_credits['totalNumberOfItems'] > 0:
+            for contributor in video_credits['items']:
+                if contributor['role'] not in credits_dict:
+                    credits_dict[contributor['role']] = []
+                credits_dict[contributor['role']].append(contributor['name'])
+
+            if credits_dict != {}:
+                '''
+                if 'save_credits_txt' in self.opts:
+                    if self.opts['save_credits_txt']:
+                        data = ''
+                        for key, value in credits_dict.items():
+                            data += key + ': '
+                            data += value + '\n'
+                        with open((os.path.splitext(track_path)[0] + '.txt'), 'w') as f:
+                            f.write(data)
+                '''
+                # Janky way to set the dict to None to tell the tagger not to include it
+                if 'embed_credits' in self.opts:
+                    if not self.opts['embed_credits']:
+                        credits_dict = None
+
+        pipe = self.opts['pipe_video_segments'] if 'pipe_video_segments' in self.opts else False
+        download_stream(video_location, video_file, url, self.opts['resolution'], track_info, credits_dict,
+                        self.connections, pipe)
+        return video_location, file_location
+
+    def prepare_track(self, track_info, album_info=None, track_num=None):
+        '''
+        Metadata stage: looks up the album if needed and creates the folders of the track
+
+        Returns the item the following stages work on
+        '''
+        track_id = track_info['id']
+        assert track_info['allowStreaming'], 'Unable to download track {0}: not allowed to stream/download'.format(
+            track_id)
 
-                if credits_dict != {}:
-                    '''
-                    if 'save_credits_txt' in self.opts:
-                        if self.opts['save_credits_txt']:
-                            data = ''
-                            for key, value in credits_dict.items():
-                                data += key + ': '
-                                data += value + '\n'
-                            with open((os.path.splitext(track_path)[0] + '.txt'), 'w') as f:
-                                f.write(data)
-                    '''
-                    # Janky way to set the dict to None to tell the tagger not to include it
-                    if 'embed_credits' in self.opts:
-                        if not self.opts['embed_credits']:
-                            credits_dict = None
+        print('=== Downloading track ID {0} ==='.format(track_id))
 
-            download_stream(video_location, video_file, url, self.opts['resolution'], track_info, credits_dict)
+        disc_location = None
+        if album_info is None:
+            print('\tGrabbing album info...')
+            tries = self.opts['tries']
+            for i in range(tries):
+                try:
+                    album_info = self.api.get_album(track_info['album']['id'])
+                    break
+                except Exception as e:
+                    print(e)
+                    print('\tGrabbing album info failed, retrying... ({}/{})'.format(i + 1, tries))
+                    if i + 1 == tries:
+                        raise
+
+        # create correct playlist numbering if track_num is present
+        if track_num:
+            if 'playlist_format' not in self.opts:
+                self.opts['playlist_format'] = "{playlistnumber} - {title}"
+
+            # ugly replace operation
+            playlist_format = self.opts['playlist_format'].replace('{playlistnumber}', str(track_num).zfill(2))
+            # Make locations
+            # path already includes the playlist name in this case
+            album_location = self.opts['path']
+            track_file = playlist_format.format(**self._normalise_info(track_info, album_info))
+        else:
+            # Make locations
+            album_location = path.join(
+                self.opts['path'], self.opts['album_format'].format(
+                    **self._normalise_info(track_info, album_info, True))).strip()
+            track_file = self.opts['track_format'].format(**self._normalise_info(track_info, album_info))
+
+            # Make multi disc directories
+            if album_info['numberOfVolumes'] > 1:
+                disc_location = path.join(
+                    album_location,
+                    'CD{num}'.format(num=track_info['volumeNumber']))
+                disc_location = re.sub(r'\.+$', '', disc_location)
+                _mkdir_p(disc_location)
+
+        album_location = re.sub(r'\.+$', '', album_location)
+        if len(track_file) > 255:  # trim filename to be under OS limit (and account for file extension)
+            track_file = track_file[:250 - len(track_file)]
+        track_file = re.sub(r'\.+$', '', track_file)
+        _mkdir_p(album_location)
+
+        return {
+            'track_info': track_info,
+            'album_info': album_info,
+            'track_num': track_num,
+            'album_location': album_location,
+            'disc_location': disc_location,
+            'track_file': track_file
+        }
 
+    @staticmethod
+    def _track_base(item):
+        # Path of the track without extension
+        if item['album_info']['numberOfVolumes'] > 1 and not item['track_num']:
+            return path.join(item['disc_location'], item['track_file'])
+        return path.join(item['album_location'], item['track_file'])
+
+    def _planned_paths(self, item):
+        '''
+        Returns the paths the finished track may have, which only depend on its metadata and the preset
+
+        The file type normally comes from the stream manifest, so every type the
+        track can end up as is listed.
+        '''
+        aac = ('HIGH', 'LOW')
+        if self.opts.get('convert_to_flac'):
+            extensions = ['flac']
+        elif self.opts['convert_to_alac']:
+            extensions = ['m4a']
+        elif item['track_info'].get('audioQuality') in aac or all(q in aac for q in self.opts['quality']):
+            # Only AAC is available or wanted
+            extensions = ['m4a']
         else:
-            if album_info is None:
-                print('\tGrabbing album info...')
-                tries = self.opts['tries']
-                for i in range(tries):
-                    try:
-                        album_info = self.api.get_album(track_info['album']['id'])
-                        break
-                    except Exception as e:
-                        print(e)
-                        print('\tGrabbing album info failed, retrying... ({}/{})'.format(i + 1, tries))
-                        if i + 1 == tries:
-                            raise
-
-            # create correct playlist numbering if track_num is present
-            if track_num:
-                if 'playlist_format' not in self.opts:
-                    self.opts['playlist_format'] = "{playlistnumber} - {title}"
-
-                # ugly replace operation
-                playlist_format = self.opts['playlist_format'].replace('{playlistnumber}', str(track_num).zfill(2))
-                # Make locations
-                # path already includes the playlist name in this case
-                album_location = self.opts['path']
-                track_file = playlist_format.format(**self._normalise_info(track_info, album_info))
-            else:
-                # Make locations
-                album_location = path.join(
-                    self.opts['path'], self.opts['album_format'].format(
-                        **self._normalise_info(track_info, album_info, True))).strip()
-                track_file = self.opts['track_format'].format(**self._normalise_info(track_info, album_info))
-
-                # Make multi disc directories
-                if album_info['numberOfVolumes'] > 1:
-                    disc_location = path.join(
-                        album_location,
-                        'CD{num}'.format(num=track_info['volumeNumber']))
-                    disc_location = re.sub(r'\.+$', '', disc_location)
-                    _mkdir_p(disc_location)
-
-            album_location = re.sub(r'\.+$', '', album_location)
-            if len(track_file) > 255:  # trim filename to be under OS limit (and account for file extension)
-                track_file = track_file[:250 - len(track_file)]
-            track_file = re.sub(r'\.+$', '', track_file)
-            _mkdir_p(album_location)
-
-            # Attempt to get stream URL
-            # stream_data = self.get_stream_url(track_id, quality)
-
-            DRM = False
-            playback_info = self.api.get_stream_url(track_id, self.opts['quality'])
-
-            manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
-            if 'ContentProtection' in manifest_unparsed:
-                DRM = True
-                print("\tWarning: DRM has been detected. If you do not have the decryption key, do not use web login.")
-            elif 'manifestMimeType' in playback_info:
-                if playback_info['manifestMimeType'] == 'application/dash+xml':
-                    raise AssertionError(f'\tUnable to download track {playback_info["trackId"]} in '
-                                         f'{playback_info["audioQuality"]}!\n')
+            # FLAC, or m4a for Dolby Atmos, Sony 360 Reality Audio and MQA in an mp4 container
+            extensions = ['flac', 'm4a']
+        base = self._track_base(item)
+        return [base + '.' + extension for extension in extensions]
+
+    def resolve_stream(self, item, overwrite=False):
+        '''
+        Stream stage: gets the playback info and decides on file type and path of the track
+
+        Returns False if the file already exists, which is checked before any request is made
+        '''
+        track_info = item['track_info']
+        track_id = track_info['id']
 
-            if not DRM:
-                manifest = json.loads(manifest_unparsed)
-                # Detect codec
-                print('\tCodec: ', end='')
-                print(technical_names[manifest['codecs']])
-
-                url = manifest['urls'][0]
-                if url.find('.flac?') == -1:
-                    if url.find('.m4a?') == -1:
-                        if url.find('.mp4?') == -1:
-                            ftype = ''
-                        else:
-                            ftype = 'm4a'
+        if not overwrite and self.library is not None:
+            # A copy of lower quality than the preset asks for is downloaded again, unless the track has nothing better
+            def rank(quality):
+                return QUALITY_RANK.get(quality, len(QUALITY_RANK))
+
+            wanted = min(self.opts['quality'], key=rank, default=None)
+            if wanted is not None and track_info.get('audioQuality') in QUALITY_RANK:
+                wanted = max(wanted, track_info['audioQuality'], key=rank)
+            known_path = self.library.find(track_id, track_info.get('isrc'), wanted)
+            if known_path is not None:
+                print('\tTrack is already in the library at {}, skipping.'.format(known_path))
+                return False
+
+        if not overwrite:
+            for planned_path in self._planned_paths(item):
+                if path.isfile(planned_path):
+                    print('\tFile {} already exists, skipping.'.format(planned_path))
+                    return False
+
+        # Attempt to get stream URL
+        # stream_data = self.get_stream_url(track_id, quality)
+
+        DRM = False
+        url = None
+        playback_info = self.api.get_stream_url(track_id, self.opts['quality'])
+
+        manifest_unparsed = base64.b64decode(playback_info['manifest']).decode('UTF-8')
+        if 'ContentProtection' in manifest_unparsed:
+            DRM = True
+            print("\tWarning: DRM has been detected. If you do not have the decryption key, do not use web login.")
+        elif 'manifestMimeType' in playback_info:
+            if playback_info['manifestMimeType'] == 'application/dash+xml':
+                raise AssertionError(f'\tUnable to download track {playback_info["trackId"]} in '
+                                     f'{playback_info["audioQuality"]}!\n')
+
+        if not DRM:
+            manifest = json.loads(manifest_unparsed)
+            # Detect codec
+            print('\tCodec: ', end='')
+            print(technical_names[manifest['codecs']])
+
+            url = manifest['urls'][0]
+            if url.find('.flac?') == -1:
+                if url.find('.m4a?') == -1:
+                    if url.find('.mp4?') == -1:
+                        ftype = ''
                     else:
                         ftype = 'm4a'
                 else:
-                    ftype = 'flac'
-            # ftype needs to be changed to work with audio codecs instead when with web auth
+                    ftype = 'm4a'
             else:
                 ftype = 'flac'
+        # ftype needs to be changed to work with audio codecs instead when with web auth
+        else:
+            ftype = 'flac'
 
-            if album_info['numberOfVolumes'] > 1 and not track_num:
-                track_path = path.join(disc_location, track_file + '.' + ftype)
-            else:
-                track_path = path.join(album_location, track_file + '.' + ftype)
-
-            if path.isfile(track_path) and not overwrite:
-                print('\tFile {} already exists, skipping.'.format(track_path))
-                return None
-
-            self.print_track_info(track_info, album_info)
-
-            if DRM:
-                manifest = manifest_unparsed
-                # Get playback link
-                pattern = re.compile(r'(?<=media=")[^"]+')
-                playback_link = pattern.findall(manifest)[0].replace("amp;", "")
-
-                # Create album tmp folder
-                tmp_folder = os.path.join(album_location, 'tmp/')
-
-                if not os.path.isdir(tmp_folder):
-                    os.makedirs(tmp_folder)
-
-                pattern = re.compile(r'(?<= r=")[^"]+')
-                # Add 2?
-                length = int(pattern.findall(manifest)[0]) + 3
-
-                # Download all chunk files from MPD
-                with open(album_location + '/encrypted.mp4', 'wb') as encrypted_file:
-                    for i in range(length):
-                        link = playback_link.replace("$Number$", str(i))
-                        filename = os.path.join(tmp_folder, str(i).zfill(3) + '.mp4')
-                        download_file([link], 0, filename)
-                        with open(filename, 'rb') as fd:
-                            shutil.copyfileobj(fd, encrypted_file)
+        track_path = self._track_base(item) + '.' + ftype
+
+        item.update(drm=DRM, manifest=manifest_unparsed if DRM else manifest, url=url, ftype=ftype,
+                    track_path=track_path, quality=playback_info.get('audioQuality'))
+
+        if path.isfile(track_path) and not overwrite:
+            print('\tFile {} already exists, skipping.'.format(track_path))
+            return False
+        return True
+
+    def transfer_track(self, item, overwrite=False):
+        '''
+        Transfer stage: downloads the track with its artwork, credits and lyrics
+
+        Returns the postprocess() job of the track
+        '''
+        track_info = item['track_info']
+        track_id = track_info['id']
+        album_info = item['album_info']
+        album_location = item['album_location']
+        track_file = item['track_file']
+        DRM = item['drm']
+        manifest = item['manifest']
+        url = item['url']
+        ftype = item['ftype']
+        track_path = item['track_path']
+
+        self.print_track_info(track_info, album_info)
+
+        if DRM:
+            # Get playback link
+            pattern = re.compile(r'(?<=media=")[^"]+')
+            playback_link = pattern.findall(manifest)[0].replace("amp;", "")
+
+            pattern = re.compile(r'(?<= r=")[^"]+')
+            # Add 2?
+            length = int(pattern.findall(manifest)[0]) + 3
+
+            def fetch_segment(i):
+                r = self.session.get(playback_link.replace("$Number$", str(i)), verify=False)
+                r.raise_for_status()
+                return r.content
+
+            # Only one DRM track per album folder at a time, they share encrypted.mp4 and prompt for a key
+            encrypted_location = path.join(album_location, 'encrypted.mp4')
+            with _path_lock(encrypted_location):
+                # Segments are fetched in parallel and appended to the container in MPD order
+                with open(encrypted_location, 'wb') as encrypted_file:
+                    for i, data in enumerate(transfer.ordered(fetch_segment, range(length), self.connections)):
+                        encrypted_file.write(data)
                         print('\tDownload progress: {0:.0f}%'.format(((i + 1) / length) * 100), end='\r')
                 print()
-                os.chdir(album_location)
 
+                decrypted_location = path.join(album_location, track_file + '.m4a')
                 decryption_key = input("\tInput key (ID:key): ")
                 print("\tDecrypting m4a")
                 try:
-                    os.system('mp4decrypt --key {} encrypted.mp4 "{}"'.format(decryption_key, track_file + '.m4a'))
+                    os.system('mp4decrypt --key {} "{}" "{}"'.format(decryption_key, encrypted_location,
+                                                                     decrypted_location))
                 except Exception as e:
                     print(e)
                     print('mp4decrypt not found!')
 
-                temp_file = track_path
+                temp_file = _unfinished(track_path)
                 print("\tRemuxing m4a to FLAC")
                 (
                     ffmpeg
-                        .input(track_file + '.m4a')
-                        .output(track_file + '.flac', acodec="copy", loglevel='warning')
+                        .input(decrypted_location)
+                        .output(temp_file, acodec="copy", loglevel='warning')
                         .overwrite_output()
                         .run()
                 )
-                shutil.rmtree("tmp")
-                os.remove('encrypted.mp4')
-                os.remove(track_file + '.m4a')
-                os.chdir('../../')
+                os.remove(encrypted_location)
+                os.remove(decrypted_location)
+
+        try:
+            if not DRM:
+                # Encrypted streams are decrypted chunk by chunk while downloading
+                decryptor = None
+                if 'encryptionType' in manifest and manifest['encryptionType'] != 'NONE':
+                    if not manifest['keyId'] == '':
+                        print('\tLooks like file is encrypted. Decrypting while downloading...')
+                        key, nonce = decrypt_security_token(manifest['keyId'])
+                        decryptor = functools.partial(ctr_decryptor, key, nonce)
 
+                temp_file = self._dl_url(url, _unfinished(track_path), decryptor)
+
+            album_art = self._get_artwork(track_info, album_info, album_location, ftype)
+
+            # Get credits from album id
+            print('\tSaving credits to file')
+            album_credits = self.credits_from_album(str(album_info['id']))
+            credits_dict = {}
             try:
-                if not DRM:
-                    temp_file = self._dl_url(url, track_path)
+                track_credits = album_credits['items'][track_info['trackNumber'] - 1]['credits']
+                for i in range(len(track_credits)):
+                    credits_dict[track_credits[i]['type']] = ''
+                    contributors = track_credits[i]['contributors']
+                    for j in range(len(contributors)):
+                        if j != len(contributors) - 1:
+                            credits_dict[track_credits[i]['type']] += contributors[j]['name'] + ', '
+                        else:
+                            credits_dict[track_credits[i]['type']] += contributors[j]['name']
 
-                    if 'encryptionType' in manifest and manifest['encryptionType'] != 'NONE':
-                        if not manifest['keyId'] == '':
-                            print('\tLooks like file is encrypted. Decrypting...')
-                            key, nonce = decrypt_security_token(manifest['keyId'])
-                            decrypt_file(temp_file, key, nonce)
+                if credits_dict != {}:
+                    if 'save_credits_txt' in self.opts:
+                        if self.opts['save_credits_txt']:
+                            data = ''
+                            for key, value in credits_dict.items():
+                                data += key + ': '
+                                data += value + '\n'
+                            with open((os.path.splitext(track_path)[0] + '.txt'), 'w') as f:
+                                f.write(data)
+                    # Janky way to set the dict to None to tell the tagger not to include it
+                    if 'embed_credits' in self.opts:
+                        if not self.opts['embed_credits']:
+                            credits_dict = None
+            except IndexError:
+                credits_dict = None
+
+            lyrics = None
+            if 'save_lyrics_lrc' in self.opts and 'embed_lyrics' in self.opts:
+                if self.opts['save_lyrics_lrc'] or self.opts['embed_lyrics']:
+                    # New API lyrics call with hacky 404 fix, pls never do it that way
+                    lyrics_data = self.lyrics_from_track(track_id)
+
+                    # Get unsynced lyrics
+                    if self.opts['embed_lyrics']:
+                        if 'lyrics' in lyrics_data and lyrics_data['lyrics']:
+                            lyrics = lyrics_data['lyrics']
+                        else:
+                            print('\tNo unsynced lyrics could be found!')
+
+                    # Get synced lyrics
+                    if self.opts['save_lyrics_lrc']:
+                        if 'subtitles' in lyrics_data and lyrics_data['subtitles']:
+                            if not os.path.isfile(os.path.splitext(track_path)[0] + '.lrc'):
+                                with open((os.path.splitext(track_path)[0] + '.lrc'), 'wb') as f:
+                                    f.write(lyrics_data['subtitles'].encode('utf-8'))
+                        else:
+                            print('\tNo synced lyrics could be found!')
+
+            return {
+                'file': temp_file,
+                'ftype': ftype,
+                'overwrite': overwrite,
+                'convert_to_alac': self.opts['convert_to_alac'],
+                'convert_to_flac': self.opts.get('convert_to_flac'),
+                'format_options': self.tm.fmtopts,
+                'quality': item['quality'],
+                'key_id': None if DRM else manifest.get('keyId'),
+                'track_info': track_info,
+                'album_info': album_info,
+                'lyrics': lyrics,
+                'credits_dict': credits_dict,
+                'album_art': album_art
+            }
+
+        # Delete the downloaded but unfinished (untagged) file on keyboard interrupt, an interrupted
+        # download is still in its .part file and will be continued on the next run
+        except KeyboardInterrupt:
+            if path.isfile(_unfinished(track_path)):
+                print('Deleting unfinished file ' + _unfinished(track_path))
+                os.remove(_unfinished(track_path))
+            raise
 
-                aa_location = path.join(album_location, 'Cover.jpg')
-                if not path.isfile(aa_location):
-                    try:
-                        artwork_size = 1200
-                        if 'artwork_size' in self.opts:
-                            if self.opts['artwork_size'] == 0:
-                                raise Exception
-                            artwork_size = self.opts['artwork_size']
-
-                        print('\tDownloading album art from iTunes...')
-                        s = requests.Session()
-
-                        params = {
-                            'country': 'US',
-                            'entity': 'album',
-                            'term': track_info['artist']['name'] + ' ' + track_info['album']['title']
-                        }
-
-                        r = s.get('https://itunes.apple.com/search', params=params)
-                        r = r.json()
-                        album_cover = None
-
-                        for i in range(len(r['results'])):
-                            if album_info['title'] == r['results'][i]['collectionName']:
-                                # Get high resolution album cover
-                                album_cover = r['results'][i]['artworkUrl100']
-                                break
-
-                        if album_cover is None:
-                            raise Exception
-
-                        compressed = 'bb'
-                        if 'uncompressed_artwork' in self.opts:
-                            if self.opts['uncompressed_artwork']:
-                                compressed = '-999'
-                        album_cover = album_cover.replace('100x100bb.jpg',
-                                                          '{}x{}{}.jpg'.format(artwork_size, artwork_size, compressed))
-                        self._dl_url(album_cover, aa_location)
-
-                        if ftype == 'flac':
-                            # Open cover.jpg to check size
-                            with open(aa_location, 'rb') as f:
-                                data = f.read()
-
-                            # Check if cover is smaller than 16MB
-                            max_size = 16777215
-                            if len(data) > max_size:
-                                print('\tCover file size is too large, only {0:.2f}MB are allowed.'.format(
-                                    max_size / 1024 ** 2))
-                                print('\tFallback to compressed iTunes cover')
-
-                                album_cover = album_cover.replace('-999', 'bb')
-                                self._dl_url(album_cover, aa_location)
-                    except:
-                        print('\tDownloading album art from Tidal...')
-                        if not self._dl_picture(track_info['album']['cover'], aa_location):
-                            aa_location = None
-
-                # Converting FLAC to ALAC
-                if self.opts['convert_to_alac'] and ftype == 'flac':
-                    print("\tConverting FLAC to ALAC...")
-                    conv_file = temp_file[:-5] + ".m4a"
-                    # command = 'ffmpeg -i "{0}" -vn -c:a alac "{1}"'.format(temp_file, conv_file)
-                    (
-                        ffmpeg
-                            .input(temp_file)
-                            .output(conv_file, acodec='alac', loglevel='warning')
-                            .overwrite_output()
-                            .run()
-                    )
-
-                    if path.isfile(conv_file) and not overwrite:
-                        print("\tConversion successful")
-                        os.remove(temp_file)
-                        temp_file = conv_file
-                        ftype = "m4a"
-                # Converting to FLAC
-                if self.opts['convert_to_flac'] and ftype != 'flac':
-                    print(f"\tConverting {ftype} to FLAC...")
-                    conv_file = re.sub(r'\.[^\.]+$', '.flac', temp_file)
-                    (
-                        ffmpeg
-                            .input(temp_file)
-                            .output(conv_file, acodec='flac', compression_level=8, loglevel='warning')
-                            .overwrite_output()
-                            .run()
-                    )
-
-                    if path.isfile(conv_file):
-                        print("\tConversion successful")
-                        os.remove(temp_file)
-                        temp_file = conv_file
-                        ftype = "flac"
-
-                # Get credits from album id
-                print('\tSaving credits to file')
-                album_credits = self.credits_from_album(str(album_info['id']))
-                credits_dict = {}
-                try:
-                    track_credits = album_credits['items'][track_info['trackNumber'] - 1]['credits']
-                    for i in range(len(track_credits)):
-                        credits_dict[track_credits[i]['type']] = ''
-                        contributors = track_credits[i]['contributors']
-                        for j in range(len(contributors)):
-                            if j != len(contributors) - 1:
-                                credits_dict[track_credits[i]['type']] += contributors[j]['name'] + ', '
-                            else:
-                                credits_dict[track_credits[i]['type']] += contributors[j]['name']
-
-                    if credits_dict != {}:
-                        if 'save_credits_txt' in self.opts:
-                            if self.opts['save_credits_txt']:
-                                data = ''
-                                for key, value in credits_dict.items():
-                                    data += key + ': '
-                                    data += value + '\n'
-                                with open((os.path.splitext(track_path)[0] + '.txt'), 'w') as f:
-                                    f.write(data)
-                        # Janky way to set the dict to None to tell the tagger not to include it
-                        if 'embed_credits' in self.opts:
-                            if not self.opts['embed_credits']:
-                                credits_dict = None
-                except IndexError:
-                    credits_dict = None
-
-                lyrics = None
-                if 'save_lyrics_lrc' in self.opts and 'embed_lyrics' in self.opts:
-                    if self.opts['save_lyrics_lrc'] or self.opts['embed_lyrics']:
-                        # New API lyrics call with hacky 404 fix, pls never do it that way
-                        lyrics_data = self.lyrics_from_track(track_id)
-
-                        # Get unsynced lyrics
-                        if self.opts['embed_lyrics']:
-                            if 'lyrics' in lyrics_data and lyrics_data['lyrics']:
-                                lyrics = lyrics_data['lyrics']
-                            else:
-                                print('\tNo unsynced lyrics could be found!')
-
-                        # Get synced lyrics
-                        if self.opts['save_lyrics_lrc']:
-                            if 'subtitles' in lyrics_data and lyrics_data['subtitles']:
-                                if not os.path.isfile(os.path.splitext(track_path)[0] + '.lrc'):
-                                    with open((os.path.splitext(track_path)[0] + '.lrc'), 'wb') as f:
-                                        f.write(lyrics_data['subtitles'].encode('utf-8'))
-                            else:
-                                print('\tNo synced lyrics could be found!')
-
-                # Tagging
-                print('\tTagging media file...')
-
-                if ftype == 'flac':
-                    self.tm.tag_flac(temp_file, track_info, album_info, lyrics, credits_dict=credits_dict,
-                                     album_art_path=aa_location)
-                elif ftype == 'm4a' or ftype == 'mp4':
-                    self.tm.tag_m4a(temp_file, track_info, album_info, lyrics, credits_dict=credits_dict,
-                                    album_art_path=aa_location)
-                else:
-                    print('\tUnknown file type to tag!')
+    def record(self, job, final_file):
+        '''
+        Adds a finished track to the library index, if there is one
+        '''
+        if self.library is None:
+            return
+        track_info = job['track_info']
+        try:
+            self.library.add(final_file, track_info['id'], track_info.get('isrc'), job['album_info']['id'],
+                             job['quality'], job.get('key_id') or None)
+        except Exception as e:
+            print('\tCould not add {} to the library index: {}'.format(final_file, e))
 
-                # Cleanup
-                if not self.opts['keep_cover_jpg'] and aa_location:
-                    os.remove(aa_location)
+    def download_media(self, track_info, album_info=None, overwrite=False, track_num=None):
+        # Check if track is video
+        if 'type' in track_info:
+            return self.download_video(track_info, overwrite)
 
-                return album_location, temp_file
+        item = self.prepare_track(track_info, album_info, track_num)
+        if not self.resolve_stream(item, overwrite):
+            return None
+        job = self.transfer_track(item, overwrite)
 
-            # Delete partially downloaded file on keyboard interrupt
-            except KeyboardInterrupt:
-                if path.isfile(track_path):
-                    print('Deleting partially downloaded file ' + str(track_path))
-                    os.remove(track_path)
-                raise
+        final_file = postprocess(job)
+        self.record(job, final_file)
+        return item['album_location'], final_file
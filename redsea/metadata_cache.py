@@ -0,0 +1,130 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = './config/cache.db'
+
+# Once the cache is larger than this, the least recently used responses are dropped
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+DAY = 24 * 60 * 60
+
+# The access time of a response is only written again after this many seconds, so most reads don't write
+ACCESS_RESOLUTION = 60 * 60
+
+# Seconds a response stays valid, by endpoint. The first match wins, None or no match isn't cached
+TTLS = [
+    (re.compile(r'/playbackinfopostpaywall$'), None),
+    (re.compile(r'/streamurl$'), None),
+    (re.compile(r'^albums/'), 30 * DAY),
+    (re.compile(r'^tracks/'), 30 * DAY),
+    (re.compile(r'^videos/'), 30 * DAY),
+    (re.compile(r'^artists/'), DAY),
+    (re.compile(r'^playlists/'), 60 * 60),
+]
+
+
+def ttl_for(endpoint):
+    for pattern, ttl in TTLS:
+        if pattern.search(endpoint):
+            return ttl
+    return None
+
+
+class MetadataCache(object):
+    '''
+    Persistent SQLite cache of API responses
+
+    Responses are keyed by endpoint and query parameters, which include the
+    country code. With refresh set, nothing is read but fresh responses are
+    still written, so the cache gets rebuilt.
+    '''
+
+    def __init__(self, path=DEFAULT_PATH, max_size=DEFAULT_MAX_SIZE, refresh=False):
+        self.max_size = max_size
+        self.refresh = refresh
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body TEXT NOT NULL, '
+                        'size INTEGER NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.db.execute('CREATE TABLE IF NOT EXISTS types (id TEXT PRIMARY KEY, type TEXT NOT NULL)')
+        self.db.commit()
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    @staticmethod
+    def _key(endpoint, params):
+        return endpoint + '?' + json.dumps(params, sort_keys=True, default=str)
+
+    def get(self, endpoint, params):
+        if self.refresh or ttl_for(endpoint) is None:
+            return None
+
+        key = self._key(endpoint, params)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT body, expires, accessed FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._delete(key)
+                self.db.commit()
+                return None
+            if now - row[2] > ACCESS_RESOLUTION:
+                self.db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+                self.db.commit()
+        return json.loads(row[0])
+
+    def put(self, endpoint, params, response):
+        ttl = ttl_for(endpoint)
+        if ttl is None:
+            return
+
+        key = self._key(endpoint, params)
+        body = json.dumps(response)
+        now = time.time()
+        with self.lock:
+            self._delete(key)
+            self.db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?)', (key, body, len(body), now + ttl, now))
+            self.size += len(body)
+            if self.size > self.max_size:
+                self._evict(now)
+            self.db.commit()
+
+    def get_type(self, id_):
+        # An id always belongs to the same kind of entity, so these never expire
+        if self.refresh:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT type FROM types WHERE id = ?', (str(id_),)).fetchone()
+        return row[0] if row else None
+
+    def put_type(self, id_, type_):
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO types VALUES (?, ?)', (str(id_), type_))
+            self.db.commit()
+
+    def _delete(self, key):
+        row = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.size -= row[0]
+
+    def _evict(self, now):
+        # Expired responses go first, then the least recently used ones until it is 10% below the limit
+        self.db.execute('DELETE FROM responses WHERE expires < ?', (now,))
+        self.size = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        target = self.max_size * 0.9
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed').fetchall():
+            if self.size <= target:
+                break
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.size -= size
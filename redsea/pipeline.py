@@ -0,0 +1,164 @@
+import queue
+import threading
+import time
+import traceback
+
+# Marks the end of work for a stage worker
+_STOP = object()
+
+
+class Stage(object):
+    '''
+    One step of a Pipeline, run by its own number of worker threads
+
+    fn is called with an item and returns whether the item moves on to the next
+    stage. Items which are not passed on, or whose fn raised, are finished.
+    '''
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+        self.processed = 0
+        self.busy = 0.0
+        self.first = None
+        self.last = None
+        self.depth_total = 0
+        self.depth_samples = 0
+        self.depth_max = 0
+        self.lock = threading.Lock()
+
+    def _record(self, start, end):
+        with self.lock:
+            self.processed += 1
+            self.busy += end - start
+            self.first = start if self.first is None else min(self.first, start)
+            self.last = end if self.last is None else max(self.last, end)
+
+    def _record_depth(self, depth):
+        with self.lock:
+            self.depth_total += depth
+            self.depth_samples += 1
+            self.depth_max = max(self.depth_max, depth)
+
+    def summary(self):
+        span = (self.last - self.first) if self.processed else 0
+        rate = self.processed / span if span > 0 else 0
+        depth = self.depth_total / self.depth_samples if self.depth_samples else 0
+        return '{0}: {1} item(s), {2:.2f}/s, {3:.1f}s busy on {4} worker(s), queue depth avg {5:.1f} max {6}'.format(
+            self.name, self.processed, rate, self.busy, self.workers, depth, self.depth_max)
+
+
+class Pipeline(object):
+    '''
+    Runs items through a list of stages connected by bounded queues
+
+    Every stage has its own workers, so different items can be in different stages
+    at the same time. A stage's queue holds at most depth items per worker, when it
+    is full the stage before it waits. With serial set, each item goes through all
+    stages in the calling thread before the next one starts. Statistics add up over
+    all runs.
+    '''
+
+    def __init__(self, stages, depth=2, serial=False):
+        self.stages = stages
+        self.depth = depth
+        self.serial = serial
+
+    def _run_serial(self, items, finished):
+        for item in items:
+            for stage in self.stages:
+                start = time.monotonic()
+                try:
+                    passed = stage.fn(item)
+                except Exception:
+                    traceback.print_exc()
+                    passed = False
+                stage._record(start, time.monotonic())
+                if not passed:
+                    break
+            if finished is not None:
+                finished(item)
+
+    def run(self, items, finished=None):
+        '''
+        Runs all items through the stages and returns once each of them is finished
+
+        items may be a generator, it is consumed as the first stage takes on more
+        work, so processing starts before all items are known. finished, if given,
+        is called with every item in the order they finish. An exception raised by
+        items is raised here once the items produced before it are finished.
+        '''
+        if self.serial:
+            return self._run_serial(items, finished)
+
+        inboxes = [queue.Queue(maxsize=self.depth * stage.workers) for stage in self.stages]
+        done = queue.Queue()
+
+        def put(index, item):
+            self.stages[index]._record_depth(inboxes[index].qsize())
+            inboxes[index].put(item)
+
+        def work(index):
+            stage = self.stages[index]
+            while True:
+                item = inboxes[index].get()
+                if item is _STOP:
+                    return
+
+                start = time.monotonic()
+                try:
+                    passed = stage.fn(item)
+                except Exception:
+                    traceback.print_exc()
+                    passed = False
+                stage._record(start, time.monotonic())
+
+                if passed and index + 1 < len(self.stages):
+                    put(index + 1, item)
+                else:
+                    done.put(item)
+
+        fed = 0
+        error = None
+
+        def feed():
+            nonlocal fed, error
+            try:
+                for item in items:
+                    fed += 1
+                    put(0, item)
+            except BaseException as e:
+                error = e
+            done.put(_STOP)
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            threads += [threading.Thread(target=work, args=(index,), daemon=True) for _ in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        # The feeder reports the end of the items once all of them were counted
+        count = 0
+        feeding = True
+        while feeding or count < fed:
+            item = done.get()
+            if item is _STOP:
+                feeding = False
+                continue
+            count += 1
+            if finished is not None:
+                finished(item)
+
+        for index, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                inboxes[index].put(_STOP)
+        for thread in threads:
+            thread.join()
+
+        if error is not None:
+            raise error
+
+    def summary(self):
+        return [stage.summary() for stage in self.stages]
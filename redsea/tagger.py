@@ -110,6 +110,12 @@ class Tagger(object):
             elif track_type == 'flac':
                 tagger['isrc'] = track_info['isrc']
 
+        # Lets redsea.py reindex find the track again
+        if track_type == 'm4a':
+            tagger['tidal_track_id'] = str(track_info['id']).encode()
+        elif track_type == 'flac':
+            tagger['TIDAL_TRACK_ID'] = str(track_info['id'])
+
         # Stupid library won't accept int so it is needed to cast it to a byte with hex value 01
         if track_info['explicit'] is not None:
             if track_type == 'm4a':
@@ -144,14 +150,13 @@ class Tagger(object):
     def _meta_tag(self, tagger, track_info, album_info, track_type):
         self.tags(track_info, track_type, album_info, tagger)
 
-    def tag_flac(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art_path=None):
+    def tag_flac(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art=None):
         tagger = FLAC(file_path)
 
         self._meta_tag(tagger, track_info, album_info, 'flac')
-        if self.fmtopts['embed_album_art'] and album_art_path is not None:
+        if self.fmtopts['embed_album_art'] and album_art is not None:
             pic = Picture()
-            with open(album_art_path, 'rb') as f:
-                pic.data = f.read()
+            pic.data = album_art
 
             # Check if cover is smaller than 16MB
             if len(pic.data) < pic._MAX_SIZE:
@@ -174,7 +179,7 @@ class Tagger(object):
 
         tagger.save(file_path)
 
-    def tag_m4a(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art_path=None):
+    def tag_m4a(self, file_path, track_info, album_info, lyrics, credits_dict=None, album_art=None):
         tagger = EasyMP4(file_path)
 
         # Register ISRC, UPC, lyrics and explicit tags
@@ -182,12 +187,11 @@ class Tagger(object):
         tagger.RegisterTextKey('upc', '----:com.apple.itunes:UPC')
         tagger.RegisterTextKey('explicit', 'rtng')
         tagger.RegisterTextKey('lyrics', '\xa9lyr')
+        tagger.RegisterTextKey('tidal_track_id', '----:com.apple.itunes:TIDAL_TRACK_ID')
 
         self._meta_tag(tagger, track_info, album_info, 'm4a')
-        if self.fmtopts['embed_album_art'] and album_art_path is not None:
-            pic = None
-            with open(album_art_path, 'rb') as f:
-                pic = MP4Cover(f.read())
+        if self.fmtopts['embed_album_art'] and album_art is not None:
+            pic = MP4Cover(album_art)
             tagger.RegisterTextKey('covr', 'covr')
             tagger['covr'] = [pic]
 
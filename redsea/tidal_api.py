@@ -11,15 +11,17 @@ import base64
 import secrets
 from datetime import datetime, timedelta
 import urllib3
+import threading
 import time
 import sys
 import prettytable
+from concurrent.futures import ThreadPoolExecutor
 
-import requests
-from urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
 from subprocess import Popen, PIPE
 
+from . import transport
+from .coalesce import get_or_fetch
+
 from config.settings import TOKEN, MOBILE_TOKEN, TV_TOKEN, TV_SECRET, WEB_TOKEN, SHOWAUTH
 
 technical_names = {
@@ -52,60 +54,99 @@ class TidalError(Exception):
         super(TidalError, self).__init__(message)
 
 
+class EntityCache(object):
+    '''
+    In-memory cache of API entities which lives for the whole run
+
+    Entries are keyed by (country code, kind, id). A request for a key which is
+    already being fetched waits for that fetch instead of asking the API again.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.pending = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    def _lookup(self, key):
+        # Called with the lock held
+        if key in self.entries:
+            self.hits[key[1]] = self.hits.get(key[1], 0) + 1
+            return True, self.entries[key]
+        return False, None
+
+    def lookup(self, key):
+        with self.lock:
+            return self._lookup(key)
+
+    def store(self, key, value):
+        with self.lock:
+            self.misses[key[1]] = self.misses.get(key[1], 0) + 1
+            self.entries[key] = value
+
+    def get(self, key, fetch):
+        return get_or_fetch(self.lock, self.pending, key, self._lookup, fetch, self.store)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def summary(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return ', '.join('{0} {1} hits/{2} misses'.format(kind, self.hits.get(kind, 0), self.misses.get(kind, 0))
+                         for kind in kinds) or 'unused'
+
+
 class TidalApi:
     TIDAL_API_BASE = 'https://api.tidal.com/v1/'
     TIDAL_VIDEO_BASE = 'https://api.tidalhifi.com/v1/'
     TIDAL_CLIENT_VERSION = '2.26.1'
 
-    def __init__(self, session):
-        self.session = session
-        self.s = requests.Session()
-        retries = Retry(total=10,
-                        backoff_factor=0.4,
-                        status_forcelist=[429, 500, 502, 503, 504])
+    # Number of playlist pages fetched at the same time
+    PAGE_CONCURRENCY = 8
 
-        self.s.mount('http://', HTTPAdapter(max_retries=retries))
-        self.s.mount('https://', HTTPAdapter(max_retries=retries))
+    # Albums, album credits and tracks, shared by all instances
+    cache = EntityCache()
 
-    def _get(self, url, params=None, refresh=False):
+    # Optional persistent MetadataCache underneath _get, shared by all instances
+    disk_cache = None
+
+    def __init__(self, session, page_concurrency=PAGE_CONCURRENCY):
+        self.session = session
+        self.page_concurrency = page_concurrency
+        self.s = transport.session()
+
+    def _prepare(self, url, params=None):
         if params is None:
             params = {}
-        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         params['countryCode'] = self.session.country_code
         if 'limit' not in params:
             params['limit'] = '9999'
 
         # Catch video for different base
         if url[:5] == 'video':
-            resp = self.s.get(
-                self.TIDAL_VIDEO_BASE + url,
-                headers=self.session.auth_headers(),
-                params=params,
-                verify=False)
-        else:
-            resp = self.s.get(
-                self.TIDAL_API_BASE + url,
-                headers=self.session.auth_headers(),
-                params=params,
-                verify=False)
+            return self.TIDAL_VIDEO_BASE + url, params
+        return self.TIDAL_API_BASE + url, params
 
+    def _can_refresh(self, status_code, refresh):
         # if the request 401s or 403s, try refreshing the TV/Mobile session in case that helps
-        if not refresh and (resp.status_code == 401 or resp.status_code == 403):
-            if isinstance(self.session, TidalMobileSession) or isinstance(self.session, TidalTvSession):
-                self.session.refresh()
-                return self._get(url, params, True)
+        return not refresh and (status_code == 401 or status_code == 403) and \
+            (isinstance(self.session, TidalMobileSession) or isinstance(self.session, TidalTvSession))
 
+    @staticmethod
+    def _parse(status_code, text):
         resp_json = None
         try:
-            resp_json = resp.json()
+            resp_json = json.loads(text)
         except:  # some tracks seem to return a JSON with leading whitespace
             try:
-                resp_json = json.loads(resp.text.strip())
+                resp_json = json.loads(text.strip())
             except:  # if this doesn't work, the HTTP status probably isn't 200. Are we rate limited?
                 pass
 
         if not resp_json:
-            raise TidalError('Response was not valid JSON. HTTP status {}. {}'.format(resp.status_code, resp.text))
+            raise TidalError('Response was not valid JSON. HTTP status {}. {}'.format(status_code, text))
 
         if 'status' in resp_json and resp_json['status'] == 404 and \
                 'subStatus' in resp_json and resp_json['subStatus'] == 2001:
@@ -121,6 +162,32 @@ class TidalApi:
 
         return resp_json
 
+    def _get(self, url, params=None, refresh=False):
+        urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+        full_url, params = self._prepare(url, params)
+        if self.disk_cache is not None:
+            cached = self.disk_cache.get(url, params)
+            if cached is not None:
+                return cached
+
+        resp = self.s.get(
+            full_url,
+            headers=self.session.auth_headers(),
+            params=params,
+            verify=False)
+
+        if self._can_refresh(resp.status_code, refresh):
+            self.session.refresh()
+            return self._get(url, params, True)
+
+        return self._store(url, params, resp.status_code, self._parse(resp.status_code, resp.text))
+
+    def _store(self, url, params, status_code, resp_json):
+        # Only proper responses are kept, not the 404 JSON which _parse lets through
+        if self.disk_cache is not None and status_code == 200:
+            self.disk_cache.put(url, params, resp_json)
+        return resp_json
+
     def get_stream_url(self, track_id, quality):
 
         return self._get('tracks/' + str(track_id) + '/playbackinfopostpaywall', {
@@ -146,7 +213,13 @@ class TidalApi:
             'offset': offset if offset else None
         })
 
+    def _cache_key(self, kind, id_):
+        return self.session.country_code, kind, str(id_)
+
     def get_credits(self, album_id):
+        return self.cache.get(self._cache_key('credits', album_id), lambda: self._get_credits(album_id))
+
+    def _get_credits(self, album_id):
         return self._get('albums/' + album_id + '/items/credits', params={
             'replace': True,
             'offset': 0,
@@ -165,26 +238,23 @@ class TidalApi:
             'locale': 'en_US'
         })
 
-    def get_playlist_items(self, playlist_id):
-        result = self._get('playlists/' + playlist_id + '/items', {
-            'offset': 0,
+    def _get_playlist_page(self, playlist_id, offset):
+        return self._get('playlists/' + playlist_id + '/items', {
+            'offset': offset,
             'limit': 100
         })
 
+    def get_playlist_items(self, playlist_id):
+        result = self._get_playlist_page(playlist_id, 0)
+
         if result['totalNumberOfItems'] <= 100:
             return result
 
-        offset = len(result['items'])
-        while True:
-            buf = self._get('playlists/' + playlist_id + '/items', {
-                'offset': offset,
-                'limit': 100
-            })
-            offset += len(buf['items'])
-            result['items'] += buf['items']
-
-            if offset >= result['totalNumberOfItems']:
-                break
+        # The total is known after the first page, the others are fetched at once and merged in order
+        offsets = range(100, result['totalNumberOfItems'], 100)
+        with ThreadPoolExecutor(max_workers=self.page_concurrency) as executor:
+            for buf in executor.map(lambda offset: self._get_playlist_page(playlist_id, offset), offsets):
+                result['items'] += buf['items']
 
         return result
 
@@ -195,10 +265,10 @@ class TidalApi:
         return self._get('albums/' + str(album_id) + '/tracks')
 
     def get_track(self, track_id):
-        return self._get('tracks/' + str(track_id))
+        return self.cache.get(self._cache_key('track', track_id), lambda: self._get('tracks/' + str(track_id)))
 
     def get_album(self, album_id):
-        return self._get('albums/' + str(album_id))
+        return self.cache.get(self._cache_key('album', album_id), lambda: self._get('albums/' + str(album_id)))
 
     def get_video(self, video_id):
         return self._get('videos/' + str(video_id))
@@ -221,29 +291,35 @@ class TidalApi:
     def get_artist_albums_ep_singles(self, artist_id):
         return self._get('artists/' + str(artist_id) + '/albums', params={'filter': 'EPSANDSINGLES'})
 
+    def _type_probes(self):
+        # In order of priority
+        return ('a', self.get_album), ('r', self.get_artist), ('t', self.get_track), ('v', self.get_video)
+
     def get_type_from_id(self, id_):
+        if self.disk_cache is not None:
+            type_ = self.disk_cache.get_type(id_)
+            if type_ is not None:
+                return type_
+
+        # All endpoints are asked at once, the first one in order of priority which knows the id wins
         result = None
+        probes = self._type_probes()
+        executor = ThreadPoolExecutor(max_workers=len(probes))
         try:
-            result = self.get_album(id_)
-            return 'a'
-        except TidalError:
-            pass
-        try:
-            result = self.get_artist(id_)
-            return 'r'
-        except TidalError:
-            pass
-        try:
-            result = self.get_track(id_)
-            return 't'
-        except TidalError:
-            pass
-        try:
-            result = self.get_video(id_)
-            return 'v'
-        except TidalError:
-            pass
-
+            futures = [(type_, executor.submit(get, id_)) for type_, get in probes]
+            for type_, future in futures:
+                try:
+                    future.result()
+                    result = type_
+                    break
+                except TidalError:
+                    pass
+        finally:
+            # Probes of lower priority are not waited for once there is a result
+            executor.shutdown(wait=False)
+
+        if result is not None and self.disk_cache is not None:
+            self.disk_cache.put_type(id_, result)
         return result
 
     @classmethod
@@ -390,7 +466,7 @@ class TidalSession:
             'clientVersion': self.TIDAL_CLIENT_VERSION
         }
 
-        r = requests.post(self.TIDAL_API_BASE + 'login/username', data=params, verify=False)
+        r = transport.session().post(self.TIDAL_API_BASE + 'login/username', data=params, verify=False)
 
         password = None
 
@@ -415,8 +491,8 @@ class TidalSession:
         '''
         Checks if subscription is either HiFi or Premium Plus
         '''
-        r = requests.get(f'{self.TIDAL_API_BASE}users/{self.user_id}/subscription',
-                         headers=self.auth_headers(), verify=False)
+        r = transport.session().get(f'{self.TIDAL_API_BASE}users/{self.user_id}/subscription',
+                                    headers=self.auth_headers(), verify=False)
         assert (r.status_code == 200)
         if r.json()['subscription']['type'] not in ['HIFI', 'PREMIUM_PLUS']:
             raise TidalAuthError('You need a HiFi subscription')
@@ -429,7 +505,7 @@ class TidalSession:
             if self.access_token is None or datetime.now() > self.expires:
                 return False
 
-        r = requests.get(f'{self.TIDAL_API_BASE}sessions', headers=self.auth_headers(), verify=False)
+        r = transport.session().get(f'{self.TIDAL_API_BASE}sessions', headers=self.auth_headers(), verify=False)
         return r.status_code == 200
 
     def auth_headers(self):
@@ -474,7 +550,7 @@ class TidalMobileSession(TidalSession):
         self.auth(password)
 
     def auth(self, password, use_recaptcha=False):
-        s = requests.Session()
+        s = transport.new_session()
 
         params = {
             'response_type': 'code',
@@ -560,7 +636,7 @@ class TidalMobileSession(TidalSession):
         oauth_code = parse_qs(url.query)['code'][0]
 
         # exchange access code for oauth token
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = transport.session().post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'code': oauth_code,
             'client_id': self.client_id,
             'grant_type': 'authorization_code',
@@ -580,7 +656,7 @@ class TidalMobileSession(TidalSession):
         if SHOWAUTH:
             print('Your Authorization token: ' + self.access_token)
 
-        r = requests.get(f'{self.TIDAL_API_BASE}sessions', headers=self.auth_headers(), verify=False)
+        r = transport.session().get(f'{self.TIDAL_API_BASE}sessions', headers=self.auth_headers(), verify=False)
         assert (r.status_code == 200)
         self.user_id = r.json()['userId']
         self.country_code = r.json()['countryCode']
@@ -589,7 +665,7 @@ class TidalMobileSession(TidalSession):
 
     def refresh(self):
         assert (self.refresh_token is not None)
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = transport.session().post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'grant_type': 'refresh_token'
@@ -652,7 +728,7 @@ class TidalTvSession(TidalSession):
         self.auth()
 
     def auth(self, password=''):
-        s = requests.Session()
+        s = transport.new_session()
 
         # retrieve csrf token for subsequent request
         r = s.post(self.TIDAL_AUTH_BASE + 'oauth2/device_authorization', data={
@@ -687,7 +763,7 @@ class TidalTvSession(TidalSession):
                 sys.stdout.flush()
                 # exchange access code for oauth token
                 time.sleep(0.2)
-            r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data=data, verify=False)
+            r = transport.session().post(self.TIDAL_AUTH_BASE + 'oauth2/token', data=data, verify=False)
             status_code = r.status_code
             index += 1  # lists are zero indexed, we need to increase by one for the accurate count
             # backtrack the written characters, overwrite them with space, backtrack again:
@@ -706,13 +782,14 @@ class TidalTvSession(TidalSession):
         if SHOWAUTH:
             print('Your Authorization token: ' + self.access_token)
 
-        r = requests.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers(), verify=False)
+        r = transport.session().get('https://api.tidal.com/v1/sessions', headers=self.auth_headers(), verify=False)
         assert (r.status_code == 200)
         self.user_id = r.json()['userId']
         self.country_code = r.json()['countryCode']
 
-        r = requests.get('https://api.tidal.com/v1/users/{}?countryCode={}'.format(self.user_id, self.country_code),
-                         headers=self.auth_headers(), verify=False)
+        r = transport.session().get(
+            'https://api.tidal.com/v1/users/{}?countryCode={}'.format(self.user_id, self.country_code),
+            headers=self.auth_headers(), verify=False)
         assert (r.status_code == 200)
         self.username = r.json()['username']
 
@@ -720,7 +797,7 @@ class TidalTvSession(TidalSession):
 
     def refresh(self):
         assert (self.refresh_token is not None)
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = transport.session().post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'client_secret': self.client_secret,
@@ -779,7 +856,7 @@ class TidalWebSession(TidalSession):
         self.auth(password)
 
     def auth(self, password, use_recaptcha=False):
-        s = requests.Session()
+        s = transport.new_session()
         params = {
             'appMode': 'WEB',
             'client_id': self.client_id,
@@ -864,7 +941,7 @@ class TidalWebSession(TidalSession):
         oauth_code = parse_qs(url.query)['code'][0]
 
         # exchange access code for oauth token
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = transport.session().post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'code': oauth_code,
             'client_id': self.client_id,
             'grant_type': 'authorization_code',
@@ -882,7 +959,7 @@ class TidalWebSession(TidalSession):
         if SHOWAUTH:
             print('Your Authorization token: ' + self.access_token)
 
-        r = requests.get('https://api.tidal.com/v1/sessions', headers=self.auth_headers(), verify=False)
+        r = transport.session().get('https://api.tidal.com/v1/sessions', headers=self.auth_headers(), verify=False)
         assert (r.status_code == 200)
         self.user_id = r.json()['userId']
         self.country_code = r.json()['countryCode']
@@ -891,7 +968,7 @@ class TidalWebSession(TidalSession):
 
     def refresh(self):
         assert (self.refresh_token is not None)
-        r = requests.post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
+        r = transport.session().post(self.TIDAL_AUTH_BASE + 'oauth2/token', data={
             'refresh_token': self.refresh_token,
             'client_id': self.client_id,
             'grant_type': 'refresh_token'
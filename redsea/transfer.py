@@ -0,0 +1,357 @@
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Files are split into ranges of this size, each fetched with its own Range request
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Size of the reusable per-thread buffer responses are read into
+BUFFER_SIZE = 1024 * 1024
+
+# How much data is written before the progress record of a .part file is updated
+CHECKPOINT_SIZE = 8 * 1024 * 1024
+CHECKPOINT_INTERVAL = 1.0
+
+# Minimum time between two progress callbacks
+PROGRESS_INTERVAL = 0.25
+
+_local = threading.local()
+
+
+class _Progress(object):
+    '''
+    Thread safe byte counter which forwards the running total to a progress callback
+
+    The callback fires at most every PROGRESS_INTERVAL seconds instead of once per chunk
+    '''
+
+    def __init__(self, callback, total, done=0):
+        self.callback = callback
+        self.total = total
+        self.done = done
+        self.reported = None
+        self.reported_at = 0
+        self.lock = threading.Lock()
+
+    def update(self, n):
+        if self.callback is None:
+            return
+        with self.lock:
+            self.done += n
+            now = time.monotonic()
+            if now - self.reported_at >= PROGRESS_INTERVAL or self.done == self.total:
+                self._report(now)
+
+    def finish(self):
+        if self.callback is None:
+            return
+        with self.lock:
+            if self.reported != self.done:
+                self._report(time.monotonic())
+
+    def _report(self, now):
+        self.reported = self.done
+        self.reported_at = now
+        self.callback(self.done, self.total)
+
+
+class _PartState(object):
+    '''
+    Progress record of a .part file
+
+    Stored next to it as .part.json, it holds the total size, whether the data was
+    decrypted on the way and the list of [start, end, written] segments so an
+    interrupted download can continue.
+    '''
+
+    def __init__(self, where, total, segments, decrypted=False):
+        self.state_file = where + '.part.json'
+        self.total = total
+        self.segments = segments
+        self.decrypted = decrypted
+        self.saved = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, where):
+        try:
+            if not os.path.isfile(where + '.part'):
+                return None
+            with open(where + '.part.json', 'r') as f:
+                record = json.load(f)
+            return cls(where, record['total'], record['segments'], record.get('decrypted', False))
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def pending(self):
+        return [i for i, (start, end, written) in enumerate(self.segments) if written < end - start + 1]
+
+    def done(self):
+        return sum(written for _, _, written in self.segments)
+
+    def commit(self, index, written, force=False):
+        with self.lock:
+            self.segments[index][2] = written
+            if force or time.monotonic() - self.saved >= CHECKPOINT_INTERVAL:
+                with open(self.state_file, 'w') as f:
+                    json.dump({'total': self.total, 'segments': self.segments, 'decrypted': self.decrypted}, f)
+                self.saved = time.monotonic()
+
+    def remove(self):
+        if os.path.isfile(self.state_file):
+            os.remove(self.state_file)
+
+
+def _content_range_total(r):
+    match = re.match(r'bytes \d+-\d+/(\d+)', r.headers.get('content-range', ''))
+    return int(match.group(1)) if match else None
+
+
+def remote_size(session, url):
+    '''
+    Returns the size of a remote file without downloading it, or None if the server doesn't tell
+
+    Tries a HEAD request first and falls back to asking for the first byte only.
+    '''
+    r = session.head(url, allow_redirects=True, verify=False)
+    r.raise_for_status()
+    if 'content-length' in r.headers and 'content-encoding' not in r.headers:
+        return int(r.headers['content-length'])
+
+    with session.get(url, stream=True, verify=False, headers={'Range': 'bytes=0-0'}) as r:
+        r.raise_for_status()
+        return _content_range_total(r)
+
+
+def _chunks(r):
+    '''
+    Yields the body of r as slices of a reusable per-thread buffer
+
+    A slice is only valid until the next one is requested
+    '''
+    if not hasattr(_local, 'buffer'):
+        _local.buffer = memoryview(bytearray(BUFFER_SIZE))
+    buffer = _local.buffer
+
+    r.raw.decode_content = True
+    while True:
+        n = r.raw.readinto(buffer)
+        if not n:
+            return
+        yield buffer[:n]
+
+
+def _write_response(r, f, state, index, progress, decryptor=None):
+    start, end, written = state.segments[index]
+    f.seek(start + written)
+    cipher = decryptor(start + written) if decryptor else None
+    unsaved = 0
+    try:
+        for chunk in _chunks(r):
+            if cipher:
+                cipher.decrypt(chunk, output=chunk)
+            f.write(chunk)
+            written += len(chunk)
+            unsaved += len(chunk)
+            progress.update(len(chunk))
+
+            # Only bytes which reached the file may be recorded as written
+            if unsaved >= CHECKPOINT_SIZE:
+                f.flush()
+                state.commit(index, written)
+                unsaved = 0
+    finally:
+        f.flush()
+        state.commit(index, written, force=True)
+
+    if written != end - start + 1:
+        raise IOError('Range {}-{} ended after {} bytes'.format(start, end, written))
+
+
+def _write_stream(r, f, progress, decryptor=None):
+    # Body of unknown length, it can't be verified or resumed so it is simply read to the end
+    cipher = decryptor(0) if decryptor else None
+    written = 0
+    for chunk in _chunks(r):
+        if cipher:
+            cipher.decrypt(chunk, output=chunk)
+        f.write(chunk)
+        written += len(chunk)
+        progress.update(len(chunk))
+    return written
+
+
+def _fetch_range(session, url, part, state, index, progress, decryptor=None):
+    start, end, written = state.segments[index]
+    r = session.get(url, stream=True, verify=False, headers={'Range': 'bytes={}-{}'.format(start + written, end)})
+    try:
+        if r.status_code != 206:
+            raise IOError('Server answered range {}-{} with HTTP {}'.format(start + written, end, r.status_code))
+        with open(part, 'r+b') as f:
+            _write_response(r, f, state, index, progress, decryptor)
+    finally:
+        r.close()
+
+
+def _preallocate(f, size):
+    # Reserves the disk space where posix_fallocate exists, elsewhere the file is only extended (sparse)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+            return
+        except OSError:
+            # Not supported by every file system
+            pass
+    f.truncate(size)
+
+
+def _discard(where):
+    for leftover in (where + '.part', where + '.part.json'):
+        if os.path.isfile(leftover):
+            os.remove(leftover)
+
+
+def download(session, url, where, connections=1, progress=None, decryptor=None):
+    '''
+    Downloads url to where, fetching byte ranges over several pooled connections
+
+    Data goes to where + '.part', which gets its disk space reserved up front where
+    the platform supports it, and is only renamed to where once its size matches
+    the reported total. An existing .part file with a progress
+    record is continued with Range requests instead of starting from zero. If the
+    server ignores the Range header the whole file is read from the first response,
+    a response without content-length is read until it ends. progress is called
+    with the bytes done so far and the total size (None if unknown), at most every
+    PROGRESS_INTERVAL seconds. decryptor, if given, is called with a byte offset
+    and returns a cipher whose decrypt() is applied to the data from that offset
+    on, so plaintext is what lands on disk. Returns the size of the file.
+    '''
+    part = where + '.part'
+    state = _PartState.load(where)
+    if state is not None and state.decrypted != (decryptor is not None):
+        _discard(where)
+        state = None
+
+    if state is not None and not state.pending():
+        # Everything arrived before, only the rename is missing
+        r = None
+    elif state is not None:
+        # Continue with the first unfinished segment
+        index = state.pending()[0]
+        start, end, written = state.segments[index]
+        r = session.get(url, stream=True, verify=False, headers={'Range': 'bytes={}-{}'.format(start + written, end)})
+        if r.status_code != 206 or _content_range_total(r) != state.total:
+            # Server ignores Range or the file changed, start over
+            r.close()
+            _discard(where)
+            return download(session, url, where, connections, progress, decryptor)
+        mode = 'r+b'
+    else:
+        headers = {'Range': 'bytes=0-{}'.format(SEGMENT_SIZE - 1)} if connections > 1 else None
+        r = session.get(url, stream=True, verify=False, headers=headers)
+        try:
+            r.raise_for_status()
+        except Exception:
+            r.close()
+            raise
+
+        if r.status_code == 206:
+            total = _content_range_total(r)
+        elif 'content-length' in r.headers:
+            total = int(r.headers['content-length'])
+        else:
+            total = None
+
+        if total is None:
+            counter = _Progress(progress, None)
+            try:
+                with open(part, 'wb') as f:
+                    total = _write_stream(r, f, counter, decryptor)
+            finally:
+                r.close()
+            counter.finish()
+            os.replace(part, where)
+            return total
+
+        # Single stream, either on purpose or because the server ignored Range
+        if r.status_code != 206:
+            segments = [[0, total - 1, 0]]
+        else:
+            segments = [[start, min(start + SEGMENT_SIZE, total) - 1, 0] for start in range(0, total, SEGMENT_SIZE)]
+        state = _PartState(where, total, segments, decryptor is not None)
+        index = 0
+        mode = 'wb'
+
+    if r is not None:
+        counter = _Progress(progress, state.total, state.done())
+        try:
+            with open(part, mode) as f:
+                if mode == 'wb':
+                    # Segments are written at their offsets into a file of the final size
+                    _preallocate(f, state.total)
+                    state.commit(index, 0, force=True)
+                remaining = [i for i in state.pending() if i != index]
+
+                if connections > 1 and remaining:
+                    with ThreadPoolExecutor(max_workers=connections - 1) as executor:
+                        futures = [executor.submit(_fetch_range, session, url, part, state, i, counter, decryptor)
+                                   for i in remaining]
+                        try:
+                            _write_response(r, f, state, index, counter, decryptor)
+                            for future in futures:
+                                future.result()
+                        except BaseException:
+                            for future in futures:
+                                future.cancel()
+                            raise
+                else:
+                    _write_response(r, f, state, index, counter, decryptor)
+                    for i in remaining:
+                        _fetch_range(session, url, part, state, i, counter, decryptor)
+        finally:
+            r.close()
+        counter.finish()
+
+    if os.path.getsize(part) != state.total or state.done() != state.total:
+        raise IOError('Download of {} is incomplete: {} of {} bytes'.format(where, state.done(), state.total))
+
+    os.replace(part, where)
+    state.remove()
+    return state.total
+
+
+def ordered(fn, items, window=8, tries=3):
+    '''
+    Calls fn for every item on window threads and yields the results in the order of items
+
+    At most window items are in flight or waiting to be consumed at a time, which also
+    bounds memory when fn returns data. A failing item is retried on its own up to
+    tries times before its error is raised.
+    '''
+
+    def attempt(item):
+        for i in range(tries):
+            try:
+                return fn(item)
+            except Exception:
+                if i + 1 == tries:
+                    raise
+                time.sleep(0.5 * (i + 1))
+
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        futures = deque(executor.submit(attempt, item) for _, item in zip(range(window), items))
+        try:
+            while futures:
+                result = futures.popleft().result()
+                for item in items:
+                    futures.append(executor.submit(attempt, item))
+                    break
+                yield result
+        finally:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,62 @@
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Retry policy of every request made through this module
+RETRIES = Retry(total=10,
+                backoff_factor=0.4,
+                status_forcelist=[429, 500, 502, 503, 504])
+
+# Keep-alive connections kept open per host
+DEFAULT_POOL_SIZE = 10
+
+_pool_size = DEFAULT_POOL_SIZE
+_adapter = None
+_session = None
+_lock = threading.Lock()
+
+
+def configure(pool_size):
+    '''
+    Sets the number of connections kept open per host, it should be at least the number
+    of requests made at the same time. Has to be called before the first request.
+    '''
+    global _pool_size
+    with _lock:
+        _pool_size = max(DEFAULT_POOL_SIZE, pool_size)
+
+
+def _get_adapter():
+    # Called with the lock held
+    global _adapter
+    if _adapter is None:
+        # Connection pools of this many hosts are kept around
+        _adapter = HTTPAdapter(max_retries=RETRIES, pool_connections=16, pool_maxsize=_pool_size)
+    return _adapter
+
+
+def new_session():
+    '''
+    Returns a new requests Session with its own cookies which shares the connection pools
+    '''
+    s = requests.Session()
+    with _lock:
+        adapter = _get_adapter()
+    s.mount('http://', adapter)
+    s.mount('https://', adapter)
+    return s
+
+
+def session():
+    '''
+    Returns the requests Session shared by the whole process
+    '''
+    global _session
+    if _session is None:
+        s = new_session()
+        with _lock:
+            if _session is None:
+                _session = s
+    return _session
@@ -9,6 +9,8 @@ from mutagen.easymp4 import EasyMP4
 from mutagen.mp4 import MP4Cover
 from mutagen.mp4 import MP4Tags
 
+from . import transfer, transport
+
 # Needed for Windows tagging support
 MP4Tags._padding = 0
 
@@ -19,7 +21,7 @@ def normalize_key(s):
 
 
 def parse_master_playlist(masterurl: str):
-    content = str(requests.get(masterurl, verify=False).content)
+    content = str(transport.session().get(masterurl, verify=False).content)
     pattern = re.compile(r"(?<=RESOLUTION=)[0-9]+x[0-9]+")
     resolution_list = pattern.findall(content)
     pattern = re.compile(r"(?<=http).+?(?=\\n)")
@@ -31,7 +33,7 @@ def parse_master_playlist(masterurl: str):
 
 
 def parse_playlist(url: str):
-    content = requests.get(url, verify=False).content
+    content = transport.session().get(url, verify=False).content
     pattern = re.compile(r"(?<=http).+?(?=\\n)")
     plist = pattern.findall(str(content))
     urllist = []
@@ -46,19 +48,8 @@ def download_file(urllist: list, part: int, filename: str):
         # print('\tFile {} already exists, skipping.'.format(filename))
         return None
 
-    r = requests.get(urllist[part], stream=True, verify=False)
-    try:
-        total = int(r.headers['content-length'])
-    except KeyError:
-        return False
-
-    with open(filename, 'wb') as f:
-        cc = 0
-        for chunk in r.iter_content(chunk_size=1024):
-            cc += 1024
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-    f.close()
+    # Written to a .part file first so an interrupted segment can be continued
+    transfer.download(transport.session(), urllist[part], filename)
 
 
 def print_video_info(track_info: dict):
@@ -78,22 +69,15 @@ def download_video_artwork(image_id: str, where: str):
     url = 'https://resources.tidal.com/images/{0}/{1}x{2}.jpg'.format(
         image_id.replace('-', '/'), 1280, 720)
 
-    r = requests.get(url, stream=True, verify=False)
+    def progress(done, total):
+        if total:
+            print("\tDownload progress: {0:.0f}%".format((done / total) * 100), end='\r')
 
     try:
-        total = int(r.headers['content-length'])
-    except KeyError:
+        transfer.download(transport.session(), url, where, progress=progress)
+    except requests.RequestException:
         return False
-    with open(where, 'wb') as f:
-        cc = 0
-        for chunk in r.iter_content(chunk_size=1024):
-            cc += 1024
-            print(
-                "\tDownload progress: {0:.0f}%".format((cc / total) * 100),
-                end='\r')
-            if chunk:  # filter out keep-alive new chunks
-                f.write(chunk)
-        print()
+    print()
     return True
 
 
@@ -145,53 +129,25 @@ def tag_video(file_path: str, track_info: dict, credits_dict: dict, album_art_pa
     tagger.save(file_path)
 
 
-def download_stream(folder_path: str, file_name: str, url: str, resolution: int, video_info: dict, credits_dict: dict):
-    tmp_folder = os.path.join(folder_path, 'tmp')
-    playlists = parse_master_playlist(url)
-    urllist = []
-
-    for playlist in playlists:
-        if resolution >= playlist['height']:
-            video_info['resolution'] = playlist['height']
-            urllist = parse_playlist(playlist['url'])
-            break
-
-    if len(urllist) <= 0:
-        print('Error: list of URLs is empty!')
-        return False
-
-    print_video_info(video_info)
-
+def _concat_segments(urllist: list, tmp_folder: str, file_path: str, window: int):
     if not os.path.isdir(tmp_folder):
         os.makedirs(tmp_folder)
 
     filelist_loc = os.path.join(tmp_folder, 'filelist.txt')
 
-    if os.path.exists(filelist_loc):
-        os.remove(filelist_loc)
-
-    filename = ""
-    for i in range(len(urllist)):
-        try:
-            filename = os.path.join(tmp_folder, str(i).zfill(3) + '.ts')
-            download_file(urllist, i, filename)
-            with open(filelist_loc, 'a') as f:
-                f.write("file '" + str(i).zfill(3) + '.ts' + "'\n")
-            percent = i / (len(urllist) - 1) * 100
+    def fetch(i):
+        # Segments only get their final name once complete, an interrupted one stays as .part
+        download_file(urllist, i, os.path.join(tmp_folder, str(i).zfill(3) + '.ts'))
+        return i
+
+    # Up to window segments are fetched at once, they are listed in playlist order as they finish
+    with open(filelist_loc, 'w') as f:
+        for i in transfer.ordered(fetch, range(len(urllist)), window):
+            f.write("file '" + str(i).zfill(3) + '.ts' + "'\n")
+            percent = (i + 1) / len(urllist) * 100
             print("\tDownload progress: {0:.0f}%".format(percent), end='\r')
-            # print(percent)
-            
-        # Delete partially downloaded file on keyboard interrupt
-        except KeyboardInterrupt:
-            if os.path.isfile(filename):
-                print('\tDeleting partially downloaded file ' + str(filename))
-                os.remove(filename)
-            raise
-        #   print("\tDownload progress: {0:.0f}%".format(percent), end='\r')
     print("\n\tDownload succeeded!")
 
-    file_path = os.path.join(folder_path, file_name + '.mp4')
-
     (
         ffmpeg
             .input(filelist_loc, format='concat', safe=0)
@@ -202,6 +158,64 @@ def download_stream(folder_path: str, file_name: str, url: str, resolution: int,
     print('\tConcatenation succeeded!')
     shutil.rmtree(tmp_folder)
 
+
+def _pipe_segments(urllist: list, file_path: str, window: int):
+    def fetch(i):
+        r = transport.session().get(urllist[i], verify=False)
+        r.raise_for_status()
+        return r.content
+
+    # ffmpeg remuxes the transport stream from stdin while segments are still arriving
+    part = file_path + '.part'
+    process = (
+        ffmpeg
+            .input('pipe:', format='mpegts')
+            .output(part, format='mp4', vcodec='copy', acodec='copy', loglevel='warning')
+            .overwrite_output()
+            .run_async(pipe_stdin=True)
+    )
+    try:
+        for i, data in enumerate(transfer.ordered(fetch, range(len(urllist)), window)):
+            process.stdin.write(data)
+            percent = (i + 1) / len(urllist) * 100
+            print("\tDownload progress: {0:.0f}%".format(percent), end='\r')
+        process.stdin.close()
+        if process.wait() != 0:
+            raise IOError('ffmpeg exited with code {}'.format(process.returncode))
+    except BaseException:
+        process.kill()
+        process.wait()
+        if os.path.isfile(part):
+            os.remove(part)
+        raise
+
+    os.replace(part, file_path)
+    print("\n\tDownload and remux succeeded!")
+
+
+def download_stream(folder_path: str, file_name: str, url: str, resolution: int, video_info: dict, credits_dict: dict,
+                    window: int = 8, pipe: bool = False):
+    playlists = parse_master_playlist(url)
+    urllist = []
+
+    for playlist in playlists:
+        if resolution >= playlist['height']:
+            video_info['resolution'] = playlist['height']
+            urllist = parse_playlist(playlist['url'])
+            break
+
+    if len(urllist) <= 0:
+        print('Error: list of URLs is empty!')
+        return False
+
+    print_video_info(video_info)
+
+    file_path = os.path.join(folder_path, file_name + '.mp4')
+    if pipe:
+        _pipe_segments(urllist, file_path, window)
+    else:
+        _concat_segments(urllist, os.path.join(folder_path, 'tmp'), file_path, window)
+
     print('\tDownloading album art ...')
     aa_location = os.path.join(folder_path, 'Cover.jpg')
     if not os.path.isfile(aa_location):
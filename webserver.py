@@ -8,7 +8,9 @@ import traceback
 import urllib3
 
 import redsea.cli as cli
+from redsea.artwork import DEFAULT_DIRECTORY as ARTWORK_DIRECTORY, ArtworkCache
 from redsea.mediadownloader import MediaDownloader
+from redsea.metadata_cache import MetadataCache
 from redsea.tagger import Tagger
 from redsea.tidal_api import TidalApi, TidalError
 from redsea.sessions import RedseaSessionFile
@@ -20,6 +22,13 @@ app = Flask(__name__)
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 os.chdir(sys.path[0])
 
+# Metadata and id types are kept between requests and restarts, album covers if the default preset gives them room
+TidalApi.disk_cache = MetadataCache()
+ARTWORK_CACHE_SIZE = PRESETS['default']['artwork_cache_size'] if 'artwork_cache_size' in PRESETS['default'] else 0
+MediaDownloader.artwork = ArtworkCache(directory=ARTWORK_DIRECTORY if ARTWORK_CACHE_SIZE > 0 else None,
+                                       disk_max_size=ARTWORK_CACHE_SIZE * 1024 * 1024)
+# The library index stays off, a track found elsewhere in the library isn't in the directory a request returns
+
 # Constants
 LOGO = """ ... """  # your logo here
 
@@ -72,6 +81,8 @@ def get_media_by_id(media_id):
 
 def download_media(media_to_download, RSF, preset):
     download_directory = ""
+    # The server runs for a long time, entities are only cached for one request
+    TidalApi.cache.clear()
     for mt in media_to_download:
         if not mt['type'] in MEDIA_TYPES:
             continue
@@ -228,8 +239,10 @@ def download_media(media_to_download, RSF, preset):
                 first = True
                 while True:
                     try:
-                        album_location, temp_file = md.download_media(track, media_info, overwrite=False, track_num=cur+1 if mt['type'] == 'p' else None)
-                        download_directory = album_location
+                        result = md.download_media(track, media_info, overwrite=False, track_num=cur+1 if mt['type'] == 'p' else None)
+                        # Skipped tracks return None
+                        if result is not None:
+                            download_directory = result[0]
                         break
                     except (ValueError, OSError, AssertionError) as e:
                         if 'Unable to download track' in str(e) and BRUTEFORCEREGION: